@@ -7,10 +7,22 @@
 import os
 import os.path
 import sys
+import argparse
+import json
 import math
+import mmap
+import queue
+import struct
+import threading
 import time
 import random
 import weakref
+import zlib
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from math import sqrt
 from random import randint
@@ -26,6 +38,12 @@ try:
 except ImportError:
     pass
 
+# NumPy is optional. Without it, the VillainStore ticks in plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 #**************************************************************************
 #   COLORS
 #**************************************************************************
@@ -35,7 +53,6 @@ FIREBRICK = (178, 34, 34)
 SEASHELL = (255, 245, 238)
 ROYAL_BLUE = (65, 105, 225)
 WHITE_SMOKE = (245, 245, 245)
-WHITE = (255, 255, 255)
 PURPLE = (186, 85, 211)
 PAPAYA_WHIP = (255, 239, 213)
 BISQUE_2 = (238, 213, 183)
@@ -48,6 +65,7 @@ DIM_GRAY = (105, 105, 105)
 DEEP_RED = (165, 42, 42)
 DARK_ORANGE = (255, 140, 0)
 LIME_GREEN = (50, 205, 50)
+WHITE = (255, 255, 255)
 
 #*************************************************************************
 #   SYSTEM SETTINGS
@@ -71,6 +89,164 @@ DEFAULT_SURFACE_SIZE = (30,20)
 #   BASE CLASSES
 #*************************************************************************
 
+def channel_order(surface, channels='RGBA', unused=None):
+    """Return the order of the color channels in `surface`'s pixels, as they
+    are laid out in memory, spelled with the letters in `channels` (for red,
+    green, blue and alpha): like 'BGRA'. Without alpha, 4-byte pixels have
+    an unused byte; it's spelled `unused`, or left out if that is None.
+    """
+    shifts = [(mask.bit_length() - 8, channel)
+              for mask, channel in zip(surface.get_masks(), channels) if mask]
+    if unused is not None and len(shifts) == 3 and surface.get_bytesize() == 4:
+        spare = ({0, 8, 16, 24} - {shift for shift, _ in shifts}).pop()
+        shifts.append((spare, unused))
+
+    order = ''.join(channel for _, channel in sorted(shifts))
+    return order[::-1] if sys.byteorder == 'big' else order
+
+class SurfaceCache:
+    """A name->surface cache with a memory budget.
+
+    The cache keeps the entries in an OrderedDict, in the order they were
+    last used - the oldest at the front, the newest at the back. Every `get`
+    moves the entry to the back. When a `put` pushes the total size over
+    `max_bytes`, entries are thrown away from the front until the cache
+    fits again. This is a "least recently used" (LRU) cache.
+
+    Pinned entries are skipped by the eviction, so they stay in memory for
+    as long as they are pinned - even if they take up more than `max_bytes`
+    between them. Then the cache is over budget, and only holds the pinned
+    entries, plus the one just added. If `max_bytes` is None, nothing is
+    ever evicted.
+    """
+
+    def __init__(self, *, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._pinned = set()
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def sizeof(surface):
+        """Return the number of bytes of pixel data held by `surface`. (For a
+        subsurface, this is the size of its part of the parent.)
+        """
+        width, height = surface.get_size()
+        return width * height * surface.get_bytesize()
+
+    def get(self, name, default=None):
+        entries = self._entries
+        if name not in entries:
+            return default
+
+        entries.move_to_end(name)
+        return entries[name]
+
+    def put(self, name, surface, *, pin=False):
+        """Add (or replace) an entry. With `pin`, it is pinned before
+        anything is evicted, so it stays even if it doesn't fit.
+        """
+        if name in self._entries:
+            self.total_bytes -= self._sizes[name]
+
+        size = self.sizeof(surface)
+        self._entries[name] = surface
+        self._entries.move_to_end(name)
+        self._sizes[name] = size
+        self.total_bytes += size
+        if pin:
+            self._pinned.add(name)
+
+        self.evict()
+
+    def pin(self, name):
+        if name not in self._entries:
+            raise KeyError(name)
+        self._pinned.add(name)
+
+    def unpin(self, name):
+        self._pinned.discard(name)
+        self.evict()
+
+    def discard(self, name):
+        """Throw out one entry, if it's there (pinned or not)."""
+        if name in self._entries:
+            del self._entries[name]
+            self.total_bytes -= self._sizes.pop(name)
+            self._pinned.discard(name)
+
+    def evict(self):
+        """Throw out least recently used, unpinned entries until the cache
+        fits in its budget.
+        """
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+
+        pinned = self._pinned
+        for name in list(self._entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if name in pinned:
+                continue
+
+            del self._entries[name]
+            self.total_bytes -= self._sizes.pop(name)
+
+class VariantCache:
+    """Tinted, flipped, and scaled versions of images. Each variant is made
+    the first time it's asked for, and after that the same surface is
+    handed back every time. So a sprite that changes color, or turns around,
+    just switches to a different (already made) surface - no pixels are
+    touched.
+
+    Variants are keyed by the base surface itself, so the base surfaces
+    should be long-lived ones, like the frames in the frame table.
+    """
+
+    def __init__(self):
+        self._variants = {}
+
+    def __len__(self):
+        return len(self._variants)
+
+    def get(self, base, tint=None, flip=False, scale=1):
+        """Return `base`, multiplied by the color `tint` (if any), mirrored
+        left-to-right if `flip`, and scaled by `scale`.
+        """
+        key = (base, tint, flip, scale)
+        variant = self._variants.get(key)
+        if variant is None:
+            variant = self._variants[key] = self.make(base, tint, flip, scale)
+        return variant
+
+    @staticmethod
+    def make(base, tint, flip, scale):
+        surface = base
+        if tint is not None:
+            # Multiply just the colors, so the transparent parts stay
+            # transparent and the shading still shows through.
+            surface = surface.copy()
+            surface.fill(tint, special_flags=BLEND_RGB_MULT)
+
+        if flip:
+            surface = pygame.transform.flip(surface, True, False)
+
+        if scale != 1:
+            width, height = surface.get_size()
+            surface = pygame.transform.scale(surface, (round(width * scale), round(height * scale)))
+
+        return surface
+
+    def clear(self):
+        self._variants.clear()
+
 class PygameResourceManager:
     """One of the frequently mentioned rules for Pygame development is
     "don't load the images more than once!" So this class exists to manage
@@ -117,23 +293,43 @@ class PygameResourceManager:
 
     You can see the issue...
 
-    The answer is a "weak reference." This is a special magic thing, that
-    has to be supported by the garbage collector, etc. Essentially, its
-    a reference that gets treated as a second-class citizen. If the GC
-    is looking at an object, and there are no "strong" references, then
-    the reference count might as well be 0. Even if there are half a dozen
-    weak references to the same object. In that case, <gobble>, the GC
-    reclaims the memory.
-
-    So I'm going to use a `weakref.WeakValueDictionary` to store weak
-    references to the objects we load. As long as *someone else* is using
-    the objects, they'll stay in the cache. But if nobody else gives the
-    object any love, then the GC will be free to reclaim the space. It's
-    not perfect, but it should get pretty good performance.
+    The answer I tried first was a "weak reference." This is a special
+    magic thing, that has to be supported by the garbage collector, etc.
+    Essentially, its a reference that gets treated as a second-class
+    citizen. If nobody else holds a "strong" reference, the GC reclaims
+    the object, even if there are half a dozen weak references to it.
+
+    That turned out to be the wrong trade. An image that is only used for
+    one frame gets collected right away, and then it has to be loaded and
+    decoded *again* the next time it's asked for. The cache barely helps.
+
+    So instead, the cache is a `SurfaceCache` (see above). It holds strong
+    references, but it has a memory budget in bytes. When the budget is
+    exceeded, the images that haven't been asked for in the longest time
+    get thrown out first. That's called "least recently used," or LRU.
+    Images that are *always* in use (the background, the hero) can be
+    pinned, so they are never thrown out no matter what.
     """
 
-    def __init__(self, *, resource_dir='.'):
-        self._resources = weakref.WeakValueDictionary()
+    # The name (under the resource dir) of an image bundle to load, if it
+    # exists. See `build_bundle`.
+    BUNDLE = None
+
+    def __init__(self, *, resource_dir='.', cache_bytes=None):
+        self._resources = SurfaceCache(max_bytes=cache_bytes)
+        self._atlas = {}
+        self.atlas_pages = []
+        self._bundle = None
+        self._bundle_index = {}
+        self._executor = None
+        self._pending = {}
+        # How many prefetches were started, and how many have finished. (Just
+        # the counts: keeping the futures would keep their surfaces, too.)
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_total = 0
+        self._prefetch_done = 0
+        self._masks = weakref.WeakKeyDictionary()
+        self._boxes = weakref.WeakKeyDictionary()
 
         if not os.path.isabs(resource_dir):
             dirs = (os.path.dirname(os.path.abspath(__file__)),
@@ -150,12 +346,287 @@ class PygameResourceManager:
 
         self.resource_dir = resource_dir
 
+        if self.BUNDLE is not None and os.path.isfile(self.get_path(self.BUNDLE)):
+            self.load_bundle(self.get_path(self.BUNDLE))
+
     def get_image(self, name):
-        if name not in self._resources:
-            path = self.get_image_path(name)
-            surface = pygame.image.load(path).convert_alpha()
-            self._resources[name] = surface
-        return self._resources[name]
+        surface = self._resources.get(name)
+        if surface is None:
+            if name in self._atlas:
+                page, rect = self._atlas[name]
+                surface = self.atlas_pages[page].subsurface(rect)
+            else:
+                surface = self.load_image(name)
+            self._resources.put(name, surface)
+        return surface
+
+    def load_image(self, name):
+        """Make a new surface for the named image, ready to blit: out of the
+        bundle if it's in there, or else by loading and decoding the file.
+        This doesn't look in (or fill) the cache - `get_image` does that.
+        """
+        future = self._pending.pop(name, None)
+        if future is not None:
+            # Wait for it, if it isn't finished yet.
+            return future.result().convert_alpha()
+
+        entry = self._bundle_index.get(name)
+        if entry is None:
+            return pygame.image.load(self.get_image_path(name)).convert_alpha()
+
+        offset, width, height, fmt = entry
+        pixels = self._bundle[offset:offset + 4 * width * height]
+        surface = pygame.image.frombuffer(pixels, (width, height), fmt)
+
+        # If the bundle was built on a machine whose display has a different
+        # pixel layout, pay for a conversion now instead of on every blit.
+        if fmt != self.display_format():
+            surface = surface.convert_alpha()
+        return surface
+
+    def get_mask(self, image):
+        """Return the collision mask for `image` (a surface, or the name of
+        one): a `pygame.mask.Mask` with a bit set for every pixel that isn't
+        transparent. Two sprites really touch only if their masks overlap.
+
+        Making a mask means looking at every pixel, so each surface's mask is
+        made once and kept. Here a weak reference IS the right trade (see
+        above): the mask is kept for exactly as long as its surface is, so
+        when a flipped or tinted variant is thrown away, its mask goes too.
+        """
+        if isinstance(image, str):
+            image = self.get_image(image)
+
+        mask = self._masks.get(image)
+        if mask is None:
+            mask = self._masks[image] = pygame.mask.from_surface(image)
+        return mask
+
+    def get_bounding_boxes(self, image):
+        """Return the boxes around the opaque parts of `image` (a surface,
+        or the name of one), as a tuple of (x, y, w, h) tuples. They come from
+        the mask (see `get_mask`), and are kept the same way.
+        """
+        if isinstance(image, str):
+            image = self.get_image(image)
+
+        boxes = self._boxes.get(image)
+        if boxes is None:
+            boxes = self._boxes[image] = tuple(
+                    tuple(rect) for rect in self.get_mask(image).get_bounding_rects())
+        return boxes
+
+    def pin(self, name):
+        """Load an image (if needed) and pin it in the cache, so that it is
+        never evicted. Returns the image.
+        """
+        surface = self.get_image(name)
+        # Put it back pinned: an image bigger than the cache's budget was
+        # evicted again as soon as `get_image` put it in.
+        self._resources.put(name, surface, pin=True)
+        return surface
+
+    def unpin(self, name):
+        """Make a pinned image evictable again."""
+        self._resources.unpin(name)
+
+    def discard(self, name):
+        """Forget an image now, instead of waiting for it to be evicted. If it
+        is still being prefetched, that is called off (if it hasn't started).
+        """
+        self._resources.discard(name)
+        future = self._pending.pop(name, None)
+        if future is not None:
+            future.cancel()
+
+    def warm(self, manifest, *, pin=False):
+        """Load every image named in `manifest` (any iterable of names) into
+        the cache ahead of time, so the first use doesn't have to decode it.
+        If `pin` is true, the images are pinned as well.
+        """
+        load = self.pin if pin else self.get_image
+        for name in manifest:
+            load(name)
+
+    def prefetch(self, names, *, workers=None):
+        """Start reading and decoding the named images in the background, on
+        a pool of `workers` threads, and return right away. Returns a
+        dictionary of name -> `concurrent.futures.Future` for the decoded
+        (but not yet converted) surface.
+
+        Nothing else has to change: when an image is first asked for, the
+        main thread waits for its decode if it isn't done yet, and then
+        converts it for the display. (Only the main thread converts, because
+        that's where the display is.) Images that are already cached, in the
+        bundle, or already being fetched are skipped.
+
+        Use `prefetch_progress` to see how far along it is.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers,
+                    thread_name_prefix='prefetch')
+
+        futures = {}
+        for name in names:
+            if name in self._resources or name in self._bundle_index or name in self._pending:
+                continue
+
+            future = self._executor.submit(pygame.image.load, self.get_image_path(name))
+            self._pending[name] = future
+            self._prefetch_total += 1
+            future.add_done_callback(self._count_prefetched)
+            futures[name] = future
+
+        return futures
+
+    def prefetch_progress(self):
+        """Return (done, total): how many of the images passed to `prefetch`
+        have finished decoding, out of how many.
+        """
+        return (self._prefetch_done, self._prefetch_total)
+
+    def _count_prefetched(self, future):
+        # This runs on the worker thread, so two could finish at once.
+        with self._prefetch_lock:
+            self._prefetch_done += 1
+
+    def build_atlas(self, names, *, page_size=(1024, 1024)):
+        """Pack the named images into as few big "atlas" surfaces (pages) as
+        possible. After this, `get_image` hands out subsurfaces of the pages
+        instead of loading the images one by one. Lots of little surfaces
+        cost more than a few big ones, and keeping the pixels next to each
+        other in memory is kinder to the CPU cache when drawing.
+
+        The packing is the simple "shelf" method: sort the images tallest
+        first, then place them left to right in rows. When a row is full,
+        start a new row below it. When a page is full, start a new page.
+
+        Images that are already in the atlas are skipped, so calling this
+        again with the same names costs nothing and adds no pages.
+
+        Returns the rect index of the images packed this time, a dictionary
+        of name -> (page, x, y, w, h).
+        """
+        atlas = self._atlas
+        images = [(name, self.load_image(name)) for name in names if name not in atlas]
+
+        images.sort(key=lambda item: item[1].get_height(), reverse=True)
+
+        page_w, page_h = page_size
+        pages = []
+        x = y = shelf_h = 0
+
+        for name, image in images:
+            w, h = image.get_size()
+            if w > page_w or h > page_h:
+                raise ValueError("Image '{}' is too big for an atlas page".format(name))
+
+            if x + w > page_w:
+                x, y, shelf_h = 0, y + shelf_h, 0
+
+            if not pages or y + h > page_h:
+                pages.append([])
+                x = y = shelf_h = 0
+
+            pages[-1].append((name, image, pygame.Rect(x, y, w, h)))
+            x += w
+            shelf_h = max(shelf_h, h)
+
+        index = {}
+        for placed in pages:
+            size = (max(rect.right for _, _, rect in placed),
+                    max(rect.bottom for _, _, rect in placed))
+            page = pygame.Surface(size, SRCALPHA).convert_alpha()
+            page.fill((0, 0, 0, 0))
+            page_no = len(self.atlas_pages)
+
+            for name, image, rect in placed:
+                # MAX against a transparent page is an exact copy, where a
+                # normal alpha blit would blend the edges with black.
+                page.blit(image, rect, special_flags=BLEND_RGBA_MAX)
+                self._atlas[name] = (page_no, rect)
+                index[name] = (page_no,) + tuple(rect)
+
+            self.atlas_pages.append(page)
+
+        return index
+
+    def write_atlas_index(self, path):
+        """Write the rect index of every atlased image to `path`, as JSON."""
+        index = {name: [page] + list(rect)
+                 for name, (page, rect) in sorted(self._atlas.items())}
+
+        with open(path, 'w') as f:
+            json.dump(index, f, sort_keys=True)
+
+    # A bundle file starts with this, then the length of the index, then the
+    # index as JSON, then the pixels.
+    BUNDLE_MAGIC = b'PGBUNDL1'
+
+    @staticmethod
+    def display_format():
+        """Return the byte order of the pixels in a `convert_alpha` surface,
+        as a pygame.image.tobytes/frombuffer format string like 'BGRA'. (The
+        display has to be set up already.)
+        """
+        channels = channel_order(pygame.Surface((1, 1), SRCALPHA).convert_alpha())
+        return channels if channels in ('RGBA', 'ARGB', 'BGRA') else 'RGBA'
+
+    def build_bundle(self, path, names):
+        """Decode the named images and write them into one bundle file at
+        `path`, as raw pixels in the display's pixel format, ready to use
+        as-is. Returns the index: name -> (offset, width, height, format).
+
+        Loading a bundle (see `load_bundle`) skips opening a file and
+        decoding a PNG for every image, which is most of the startup time.
+        Build the bundle again whenever the images change!
+        """
+        fmt = self.display_format()
+        index = {}
+        chunks = []
+        offset = 0
+
+        for name in names:
+            image = pygame.image.load(self.get_image_path(name)).convert_alpha()
+            pixels = pygame.image.tobytes(image, fmt)
+            index[name] = (offset, image.get_width(), image.get_height(), fmt)
+            chunks.append(pixels)
+            offset += len(pixels)
+
+        header = json.dumps(index, sort_keys=True).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(self.BUNDLE_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for pixels in chunks:
+                f.write(pixels)
+
+        return index
+
+    def load_bundle(self, path):
+        """Map an image bundle made by `build_bundle` into memory. After this,
+        images in the bundle are made straight from the mapped pixels (see
+        `load_image`); any others are still loaded from their own files.
+
+        The file is mapped "copy on write," so the pages are only read from
+        disk when they are used, and drawing on a surface made from them
+        never changes the file.
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic = self.BUNDLE_MAGIC
+        if mapped[:len(magic)] != magic:
+            raise ValueError("'{}' is not an image bundle".format(path))
+
+        start = len(magic) + 4
+        header_len, = struct.unpack('<I', mapped[len(magic):start])
+        index = json.loads(mapped[start:start + header_len].decode('utf-8'))
+
+        data = start + header_len
+        self._bundle = memoryview(mapped)
+        self._bundle_index = {name: (data + offset, width, height, fmt)
+                              for name, (offset, width, height, fmt) in index.items()}
 
     def get_image_path(self, name):
         """Overloadable method to compute the path to an image file.
@@ -175,19 +646,626 @@ class PygameResourceManager:
         if repeat is not None:
             pygame.mixer.music.play(repeat)
 
+    def play_music(self, name, *, loops=-1):
+        """Start streaming a piece of music, replacing whatever was playing.
+        With `loops` -1 (the default) it repeats forever. The mixer loops it
+        by itself, so there's no gap between the end and the start again.
+        """
+        pygame.mixer.music.load(self.get_music_path(name))
+        pygame.mixer.music.play(loops)
+
     def get_music_path(self, name):
         """Overloadable method to compute the path to an music file.
         By overloading this, you can insert subdirs, etc.
         """
         return self.get_path(name)
 
+    def load_sounds(self, names):
+        """Load and decode the named sound effects, and return a dictionary
+        of name (without the extension) -> pygame.mixer.Sound. Unlike music,
+        sounds are decoded into memory all at once, so do this ahead of time
+        - not in the middle of a fight.
+        """
+        return {os.path.splitext(os.path.basename(name))[0]:
+                    pygame.mixer.Sound(self.get_sound_path(name))
+                for name in names}
+
+    def get_sound_path(self, name):
+        """Overloadable method to compute the path to a sound file.
+        By overloading this, you can insert subdirs, etc.
+        """
+        return self.get_path(name)
+
     def get_path(self, *paths):
         return os.path.normpath(os.path.join(self.resource_dir, *paths))
 
+class SpatialHash:
+    """A uniform grid of cells over the game world, for finding the sprites
+    near a place without looking at every sprite.
+
+    Each sprite is filed under every cell its `rect` touches. To find the
+    sprites that overlap a rect, only the sprites in the cells under that
+    rect need to be checked. With `cell_size` about the size of a sprite,
+    that is a handful of sprites no matter how many there are in total.
+
+    Sprites don't tell anyone when their rect moves, so call `update` for
+    a sprite after it might have moved. That's cheap when it is still in
+    the same cells, which is most of the time.
+    """
+
+    def __init__(self, *, cell_size=64):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._bounds = {}
+
+    def __contains__(self, sprite):
+        return sprite in self._bounds
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def _cell_bounds(self, left, top, right, bottom):
+        size = self.cell_size
+        return (left // size, top // size,
+                max(right - 1, left) // size, max(bottom - 1, top) // size)
+
+    def _add(self, sprite, bounds):
+        cells = self._cells
+        cx0, cy0, cx1, cy1 = bounds
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    cell = cells[cx, cy] = {}
+                cell[sprite] = None
+
+    def _discard(self, sprite, bounds):
+        cells = self._cells
+        cx0, cy0, cx1, cy1 = bounds
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = cells[cx, cy]
+                del cell[sprite]
+                if not cell:
+                    del cells[cx, cy]
+
+    def insert(self, sprite):
+        rect = sprite.rect
+        bounds = self._cell_bounds(rect.left, rect.top, rect.right, rect.bottom)
+        self._bounds[sprite] = bounds
+        self._add(sprite, bounds)
+        sprite.spatial_index = self
+
+    def remove(self, sprite):
+        bounds = self._bounds.pop(sprite, None)
+        if bounds is not None:
+            self._discard(sprite, bounds)
+            sprite.spatial_index = None
+
+    def update(self, sprite):
+        """Re-file `sprite` if its rect has moved into different cells."""
+        rect = sprite.rect
+        bounds = self._cell_bounds(rect.left, rect.top, rect.right, rect.bottom)
+        old = self._bounds[sprite]
+        if bounds != old:
+            self._discard(sprite, old)
+            self._add(sprite, bounds)
+            self._bounds[sprite] = bounds
+
+    def _candidates(self, left, top, right, bottom):
+        cells = self._cells
+        found = {}
+        cx0, cy0, cx1, cy1 = self._cell_bounds(left, top, right, bottom)
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                cell = cells.get((cx, cy))
+                if cell is not None:
+                    found.update(cell)
+        return found
+
+    def query_rect(self, rect):
+        """Return a list of the sprites whose rect overlaps `rect`."""
+        return [sprite for sprite in self._candidates(rect.left, rect.top, rect.right, rect.bottom)
+                if sprite.rect.colliderect(rect)]
+
+    def query_range(self, x, y, dx, dy):
+        """Return a list of the sprites whose position (the top-left corner
+        of the rect) is less than `dx` away from `x` and `dy` away from `y`.
+        """
+        return [sprite for sprite in self._candidates(x - dx, y - dy, x + dx + 1, y + dy + 1)
+                if abs(sprite.rect.x - x) < dx and abs(sprite.rect.y - y) < dy]
+
+class Stage:
+    """The layout of a level's background: a row of `chunk_names`, the
+    images for each piece of the level from left to right. Every chunk is
+    `chunk_size` (an image can be bigger; the rest of it isn't shown). The
+    same image can be used for more than one chunk.
+
+    A stage can be as long as it likes, because only the chunks near the
+    camera are ever loaded - see StageBackground.
+    """
+
+    def __init__(self, chunk_names, chunk_size):
+        self.chunk_names = tuple(chunk_names)
+        self.chunk_size = chunk_size
+        width, height = chunk_size
+        self.rect = pygame.Rect(0, 0, width * len(self.chunk_names), height)
+
+    def columns(self, left, right):
+        """Return the range of chunk numbers that cover x from `left` up to
+        (but not including) `right`.
+        """
+        width = self.chunk_size[0]
+        first = max(left // width, 0)
+        last = min((right - 1) // width, len(self.chunk_names) - 1)
+        return range(first, last + 1)
+
+class Camera:
+    """The part of the game world that is on the screen: `rect`, in world
+    coordinates. The camera follows a target (see `follow`), without going
+    outside `bounds`.
+
+    Like the sprites, the camera remembers where it was one model frame
+    ago (`prev_pos`), so the view can scroll smoothly between frames.
+    """
+
+    def __init__(self, size, bounds):
+        self.rect = pygame.Rect((0, 0), size)
+        self.bounds = bounds
+        self.rect.clamp_ip(bounds)
+        self.prev_pos = self.rect.topleft
+
+    def follow(self, target):
+        """Move, if need be, to keep the rect `target` out of the outer
+        thirds of the screen. Call this once per model frame.
+        """
+        rect = self.rect
+        self.prev_pos = rect.topleft
+
+        margin = rect.width // 3
+        if target.left < rect.left + margin:
+            rect.left = target.left - margin
+        elif target.right > rect.right - margin:
+            rect.right = target.right + margin
+        rect.clamp_ip(self.bounds)
+
+    def offset(self, alpha=1.0):
+        """Return the world position of the top-left of the screen, `alpha`
+        of the way from last frame's position to this frame's.
+        """
+        x, y = self.prev_pos
+        rect = self.rect
+        if alpha >= 1.0:
+            return rect.topleft
+        return (round(x + (rect.x - x) * alpha), round(y + (rect.y - y) * alpha))
+
+class StageBackground:
+    """Draws a Stage, loading its chunks as the camera gets near them and
+    throwing them away once it has gone past.
+
+    Each frame, `update` looks at where the camera is:
+
+      - chunks within `lookahead` pixels of the screen are prefetched (see
+        PygameResourceManager.prefetch), so they are decoded by the time
+        they scroll into view, without holding up the game;
+
+      - chunks more than twice that far away are discarded. (The gap in
+        between is so that a player walking back and forth at the edge
+        doesn't make a chunk load, unload, and load again.)
+
+    So however long the stage is, only a few screens' worth of it is in
+    memory. And `draw` only blits the parts of the chunks that are on the
+    screen, so drawing it costs the same as drawing one screen-sized image.
+
+    A background has nothing to see through, so each chunk is kept without
+    its alpha channel (see `get_chunk`). Blitting an opaque surface is a
+    straight copy, about four times faster than blending every pixel.
+    """
+
+    def __init__(self, stage, resource_manager, *, lookahead=None):
+        self.stage = stage
+        self.resource_manager = resource_manager
+        self.lookahead = stage.chunk_size[0] if lookahead is None else lookahead
+        self.loaded = set()
+        self.chunks = {}
+
+    def update(self, view):
+        """Load and unload chunks for the camera's rect, `view`."""
+        stage = self.stage
+        names = stage.chunk_names
+        ahead = self.lookahead
+
+        wanted = {names[col] for col in stage.columns(view.left - ahead, view.right + ahead)}
+        keep = {names[col] for col in stage.columns(view.left - 2 * ahead, view.right + 2 * ahead)}
+
+        fetch = wanted - self.loaded
+        if fetch:
+            self.resource_manager.prefetch(sorted(fetch))
+            self.loaded |= fetch
+
+        for name in self.loaded - keep:
+            self.chunks.pop(name, None)
+            self.resource_manager.discard(name)
+        self.loaded &= keep
+
+    def get_chunk(self, name):
+        """Return the chunk image called `name`, ready to blit."""
+        chunk = self.chunks.get(name)
+        if chunk is None:
+            # Only the opaque copy is kept, not the resource manager's.
+            rmgr = self.resource_manager
+            chunk = self.chunks[name] = rmgr.get_image(name).convert()
+            rmgr.discard(name)
+        return chunk
+
+    def draw(self, surface, offset, area=None):
+        """Draw the stage on `surface`, with the world position `offset` at
+        the top-left. Only the part inside `area` (a rect on the surface;
+        default, all of it) is drawn.
+        """
+        if area is None:
+            area = surface.get_rect()
+
+        stage = self.stage
+        x, y = offset
+        world = area.move(x, y).clip(stage.rect)
+        if not world:
+            return
+
+        get_chunk = self.get_chunk
+        width, height = stage.chunk_size
+        for col in stage.columns(world.left, world.right):
+            left = col * width
+            part = world.clip((left, 0, width, height))
+            surface.blit(get_chunk(stage.chunk_names[col]), (part.x - x, part.y - y),
+                         part.move(-left, 0))
+
+class ChannelPool:
+    """Plays sound effects on a fixed set of mixer channels, so a pile of
+    sounds at once can never hold up the game.
+
+    Each sound is played with a `priority`. If every channel is busy, the
+    new sound takes over ("steals") the channel playing the least important
+    sound - the oldest one, if there's a tie - as long as that's no more
+    important than the new sound. Otherwise the new sound is just dropped.
+
+    All the channels are set up in advance, and `play` only looks through
+    them; it doesn't make anything new.
+    """
+
+    def __init__(self, *, channels=16):
+        pygame.mixer.set_num_channels(channels)
+        self.channels = tuple(pygame.mixer.Channel(i) for i in range(channels))
+        self.priority = [0] * channels
+        self.started = [0] * channels
+        self.plays = 0
+
+    def play(self, sound, priority=0):
+        """Play `sound` on a free channel, or steal one. Returns the channel
+        index, or -1 if the sound was dropped (or is None).
+        """
+        if sound is None:
+            return -1
+
+        channels = self.channels
+        priorities = self.priority
+        started = self.started
+
+        victim = -1
+        for i, channel in enumerate(channels):
+            if not channel.get_busy():
+                victim = i
+                break
+
+            if priorities[i] <= priority and (victim < 0
+                    or (priorities[i], started[i]) < (priorities[victim], started[victim])):
+                victim = i
+
+        if victim >= 0:
+            self.plays += 1
+            priorities[victim] = priority
+            started[victim] = self.plays
+            channels[victim].play(sound)
+
+        return victim
+
+    def stop(self):
+        for channel in self.channels:
+            channel.stop()
+
+def percentile(sorted_values, pct):
+    """Return the `pct` percentile (0-100) of `sorted_values`, which must be
+    sorted already: the value nearest to `pct` percent of the way from the
+    smallest to the biggest. An empty list gives 0.0. The profiler
+    (FrameStats) and the benchmarks both use this, so their numbers agree.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class FrameStats:
+    """Rolling timings for each phase of the event loop: handling `events`,
+    running the `model`, drawing the `view`, and `sleep`ing in clock.tick.
+    The `frame` phase is the whole trip around the loop.
+
+    Only the last `window` frames are kept, in one fixed-size ring of floats
+    per phase, so recording a frame never allocates anything. Percentiles
+    are worked out when somebody asks for them.
+
+    A frame is *over budget* when its work (everything but the sleeping)
+    takes more than `budget` seconds.
+    """
+
+    PHASES = ('events', 'model', 'view', 'sleep', 'frame')
+
+    def __init__(self, *, budget, window=300):
+        self.budget = budget
+        self.window = window
+        self.frames = 0
+        self.over_budget = 0
+        self._samples = {phase: array('d', bytes(8 * window)) for phase in self.PHASES}
+
+        # For the overlay.
+        self._font = None
+        self._text = None
+
+    def record(self, events, model, view, sleep):
+        """Store the seconds spent in each phase of one frame."""
+        i = self.frames % self.window
+        samples = self._samples
+        samples['events'][i] = events
+        samples['model'][i] = model
+        samples['view'][i] = view
+        samples['sleep'][i] = sleep
+        samples['frame'][i] = events + model + view + sleep
+
+        self.frames += 1
+        if events + model + view > self.budget:
+            self.over_budget += 1
+
+    def samples(self, phase):
+        """Return the recorded seconds for `phase`, oldest first."""
+        ring = self._samples[phase]
+        if self.frames <= self.window:
+            return ring[:self.frames].tolist()
+        i = self.frames % self.window
+        return (ring[i:] + ring[:i]).tolist()
+
+    def percentile(self, phase, pct):
+        """Return the `pct` percentile (0-100) of the seconds spent in `phase`
+        over the window, or 0.0 if nothing was recorded yet.
+        """
+        return percentile(sorted(self.samples(phase)), pct)
+
+    def summary(self):
+        """Return {phase: {'p50', 'p95', 'p99', 'max'}} in milliseconds,
+        plus 'frames' and 'over_budget' counts.
+        """
+        result = {'frames': self.frames, 'over_budget': self.over_budget}
+        for phase in self.PHASES:
+            values = sorted(self.samples(phase))
+            result[phase] = {
+                'p50': 1000.0 * percentile(values, 50),
+                'p95': 1000.0 * percentile(values, 95),
+                'p99': 1000.0 * percentile(values, 99),
+                'max': 1000.0 * percentile(values, 100),
+            }
+        return result
+
+    def report(self):
+        """Return the summary as a small text table, one line per phase."""
+        summary = self.summary()
+        lines = ['{:<7} {:>7} {:>7} {:>7} {:>7}'.format('ms', 'p50', 'p95', 'p99', 'max')]
+        for phase in self.PHASES:
+            lines.append('{:<7} {p50:7.2f} {p95:7.2f} {p99:7.2f} {max:7.2f}'.format(
+                phase, **summary[phase]))
+        lines.append('{} frames, {} over budget'.format(summary['frames'], summary['over_budget']))
+        return lines
+
+    def draw_overlay(self, screen):
+        """Draw the report in the top-left corner of `screen`, and return the
+        rect that was drawn. Add this to a view's `overlays` to see it live.
+        The text is only re-rendered every so often, because that is slow.
+        """
+        if self._text is None or self.frames % 30 == 0:
+            if self._font is None:
+                self._font = pygame.font.Font(None, 18)
+            lines = [self._font.render(line, True, WHITE, BLACK) for line in self.report()]
+            height = lines[0].get_height()
+            self._text = pygame.Surface((max(line.get_width() for line in lines),
+                                         height * len(lines)))
+            for n, line in enumerate(lines):
+                self._text.blit(line, (0, n * height))
+
+        return screen.blit(self._text, (0, 0))
+
+class FrameCapture:
+    """Records frames - copies of a surface, usually the screen - and
+    writes them to disk on background threads, so the game never waits for
+    the disk or for compression.
+
+    The frames go through a ring of `slots` buffers, all allocated up front.
+    `add` copies the surface's pixels into a free buffer, just as they are
+    (no conversion), and hands it to the writer threads. When a writer is
+    done with a buffer, it goes back in the ring.
+
+    If the writers fall behind and every buffer is full, `add` either waits
+    for one (if `block` is true: for offline recording, like a replay) or
+    skips the frame and counts it in `dropped` (for recording a live game,
+    which mustn't stall).
+
+    The `format` is one of:
+
+      - 'png': one PNG file per frame. `path` is a pattern like
+        'capture/frame-%06d.png', or a directory to put frame-000000.png,
+        frame-000001.png, ... in. The PNGs are compressed with zlib, which
+        (unlike pygame.image.save) lets the game thread carry on while it
+        works, and `writers` threads can do that at once.
+
+      - 'raw': every frame's pixels, one after the other, in the file
+        `path`. There's no header, so it's tiny and fast to write; see
+        `ffmpeg_args` for how to read it.
+    """
+
+    FORMATS = ('png', 'raw')
+
+    def __init__(self, surface, path, *, format='png', slots=8, writers=None, block=False,
+            compress_level=1):
+        if format not in self.FORMATS:
+            raise ValueError('Unknown capture format {!r}'.format(format))
+
+        if format == 'png':
+            if '%' not in path:
+                os.makedirs(path, exist_ok=True)
+                path = os.path.join(path, 'frame-%06d.png')
+            if writers is None:
+                writers = min(4, os.cpu_count() or 1)
+        else:
+            # A stream has to be written in order, so only one writer.
+            writers = 1
+
+        self.format = format
+        self.path = path
+        self.block = block
+        self.compress_level = compress_level
+        self.size = surface.get_size()
+        self.template = surface
+        self.pitch = surface.get_pitch()
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+
+        frame_bytes = self.pitch * self.size[1]
+        self._buffers = [bytearray(frame_bytes) for _ in range(max(slots, writers))]
+        self._free = queue.Queue()
+        for slot in range(len(self._buffers)):
+            self._free.put(slot)
+        self._full = queue.Queue()
+
+        self._stream = open(path, 'wb') if format == 'raw' else None
+        self._threads = [threading.Thread(target=self._write_frames, name='capture', daemon=True)
+                         for _ in range(writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, surface):
+        """Capture one frame of `surface`. Returns False if it was dropped."""
+        try:
+            slot = self._free.get(block=self.block)
+        except queue.Empty:
+            self.dropped += 1
+            return False
+
+        pixels = surface.get_buffer()
+        memoryview(self._buffers[slot])[:] = pixels
+        del pixels  # The surface is locked for as long as this is around.
+
+        self._full.put((slot, self.frames))
+        self.frames += 1
+        return True
+
+    def close(self):
+        """Wait for every captured frame to be written, and stop."""
+        for _ in self._threads:
+            self._full.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        if self._stream is not None:
+            self._stream.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def ffmpeg_args(self, framerate):
+        """Return the ffmpeg input options that read a 'raw' capture."""
+        width, height = self.size
+        return ['-f', 'rawvideo', '-pixel_format', self.pixel_format(),
+                '-video_size', '{}x{}'.format(width, height),
+                '-framerate', str(framerate), '-i', self.path]
+
+    def pixel_format(self):
+        """Return the byte order of the captured pixels, as ffmpeg names it:
+        like 'bgr0', for blue, green, red, and an unused byte.
+        """
+        return channel_order(self.template, 'rgba', unused='0')
+
+    def _write_frames(self):
+        # Each writer has a surface of its own to put the pixels back into.
+        scratch = pygame.Surface(self.size, 0, self.template)
+
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
+
+            slot, number = item
+            try:
+                if self._stream is not None:
+                    self._write_raw(self._buffers[slot])
+                else:
+                    pixels = scratch.get_buffer()
+                    memoryview(pixels)[:] = self._buffers[slot]
+                    del pixels
+                    with open(self.path % number, 'wb') as file:
+                        file.write(self.encode_png(scratch, self.compress_level))
+            except Exception as error:
+                # Keep going (so `add` never waits forever), and tell `close`.
+                if self.error is None:
+                    self.error = error
+            finally:
+                self._free.put(slot)
+
+    def _write_raw(self, buffer):
+        width, height = self.size
+        row = width * self.template.get_bytesize()
+        if self.pitch == row:
+            self._stream.write(buffer)
+        else:
+            # Leave out the padding at the end of each row.
+            view = memoryview(buffer)
+            for y in range(0, height * self.pitch, self.pitch):
+                self._stream.write(view[y:y + row])
+
+    @staticmethod
+    def encode_png(surface, level=1):
+        """Return `surface` as the bytes of an RGB PNG file."""
+        width, height = surface.get_size()
+        pixels = pygame.image.tobytes(surface, 'RGB')
+        stride = 3 * width
+
+        # Each row starts with its filter type; 0 is "none".
+        rows = b''.join(b'\x00' + pixels[y:y + stride] for y in range(0, height * stride, stride))
+
+        def chunk(kind, data):
+            return (struct.pack('>I', len(data)) + kind + data +
+                    struct.pack('>I', zlib.crc32(kind + data)))
+
+        return (b'\x89PNG\r\n\x1a\n' +
+                chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(rows, level)) +
+                chunk(b'IEND', b''))
+
 #*************************************************************************
 #   Model / View / Controller Base classes
 #*************************************************************************
 
+def ignored_event(handler):
+    """Mark an event handler method as one that does nothing. Events with an
+    ignored handler are blocked (see PygameController._get_event_handlers).
+    """
+    handler.ignored = True
+    return handler
+
+def static_overlay(overlay):
+    """Mark a view overlay (see PygameView.overlays) as one that always draws
+    the same thing in the same place. In dirty-rect mode, it is then only
+    redrawn where something under it changed, instead of every frame.
+    """
+    overlay.static = True
+    return overlay
+
 class PygameController:
     """
     I have chosen to adapt a Model/View/Controller approach for this code.
@@ -228,15 +1306,38 @@ class PygameController:
     either pass or die, and you don't need either one of those behaviors.
 
     The exception to the above is the event_QUIT handler, which knows that it
-    should set `self.active` to False.
+    should set `self.active` to False, and the event_VIDEORESIZE and
+    event_VIDEOEXPOSE handlers, which tell the view to redraw everything.
+
+    Events nobody handles are never even queued: the types whose handler is
+    still the do-nothing default are blocked when the controller is made.
+    And mouse and joystick motion, which can arrive hundreds at a time, is
+    merged down to one event per frame before it's handled.
 
     The `run` method is a Pygame event loop. It will loop until the `self.active`
     attribute is false. Each time through the loop it consumes all received
-    events, calls the model's `update_frame()` method, waits until enough time
-    has passed, checks the `self.active` value, and repeats.
+    events, calls the model's `update_frame()` method as many times as the
+    clock says it should have been called (see below), updates the view,
+    checks the `self.active` value, and repeats.
+
+    The model runs on a "fixed timestep": `update_frame` is called exactly
+    `framerate_hz` times per second of real time, no matter how fast or slow
+    the drawing is. (Things like "attack for 20 frames" mean 20 model frames.)
+    If the drawing falls behind, the model is called several times in a row
+    to catch up - but never more than `max_catchup_frames` times, so a really
+    slow machine slows the game down instead of falling further and further
+    behind. The view is updated once per trip around the loop, at most
+    `render_hz` times per second (None means as fast as possible).
+
+    If `profile` is true, `run` is replaced with `run_profiled`, which does
+    the same thing but times each part of the loop into `self.stats` (a
+    FrameStats). A frame is over budget if it takes longer than `frame_budget`
+    seconds, which defaults to one render frame. With `profile` off, the
+    plain `run` has no timing code in it at all.
     """
 
-    def __init__(self, *, framerate_hz=16, model=None, support_dropfile=False, view=None):
+    def __init__(self, *, framerate_hz=16, model=None, support_dropfile=False, view=None,
+            render_hz=None, max_catchup_frames=5, profile=False, frame_budget=None):
         """
         The `*,` in the parameter list means that all the following parameters
         are *keyword-only*. This means they can only be specified using the
@@ -245,6 +1346,8 @@ class PygameController:
         """
         self.active = False
         self.framerate_hz = framerate_hz
+        self.render_hz = render_hz
+        self.max_catchup_frames = max_catchup_frames
         self.model = model
         self.view = view
 
@@ -252,55 +1355,75 @@ class PygameController:
         self.support_dropfile = support_dropfile
         self._event_handlers = self._get_event_handlers()
 
-    def event_unsupported(self, evt):
-        """Handle any event not defined by Pygame"""
-        raise ValueError('Event of unknown type: ' + repr(evt))
+        self.stats = None
+        if profile:
+            if frame_budget is None:
+                frame_budget = 1.0 / (render_hz or framerate_hz)
+            self.stats = FrameStats(budget=frame_budget)
+            self.run = self.run_profiled
+
+    @ignored_event
+    def event_unhandled(self, evt):
+        """Handle any event type that has no handler method. These are blocked,
+        so they shouldn't get here, but if one does, it is ignored."""
+        pass
 
     def event_NOEVENT(self, evt):
         """Handle any NOEVENT(0) events. These should never happen by default - creating an event
         of this type is something the user must have done for whatever (bogus) reason."""
         raise ValueError('Events of type NOEVENT should never occur.')
 
+    @ignored_event
     def event_ACTIVEEVENT(self, evt):
         """Handle ACTIVEEVENT(1): the window has gained focus/become active."""
         pass
 
+    @ignored_event
     def event_KEYDOWN(self, evt):
         """Handle KEYDOWN(3): A key has been pressed down"""
         pass
 
+    @ignored_event
     def event_KEYUP(self, evt):
         """Handle KEYUP(3): A key has been released."""
         pass
 
+    @ignored_event
     def event_MOUSEMOTION(self, evt):
         """Handle MOUSEMOTION(4): A mouse has moved."""
         pass
 
+    @ignored_event
     def event_MOUSEBUTTONDOWN(self, evt):
         """Handle MOUSEBUTTONDOWN(5): A mouse button has been pressed."""
         pass
 
+    @ignored_event
     def event_MOUSEBUTTONUP(self, evt):
         """Handle MOUSEBUTTONUP(6): A mouse button has been released."""
         pass
 
+    @ignored_event
     def event_JOYAXISMOTION(self, evt):
         """Handle JOYAXISMOTION(7): A joystick has moved on at least one axis."""
         pass
 
+    @ignored_event
     def event_JOYBALLMOTION(self, evt):
         """Handle JOYBALLMOTION(8): Joyball/trackball has been moved."""
         pass
 
+    @ignored_event
     def event_JOYHATMOTION(self, evt):
         """Handle JOYHATMOTION(9): Joyhat switch has been pressed."""
         pass
 
+    @ignored_event
     def event_JOYBUTTONDOWN(self, evt):
         """Handle JOYBUTTONDOWN(10): Joystick button pressed."""
         pass
 
+    @ignored_event
     def event_JOYBUTTONUP(self, evt):
         """Handle JOYBUTTONUP(11): Joystick button released."""
         pass
@@ -309,112 +1432,275 @@ class PygameController:
         """Handle QUIT(12): User clicks the close-window button, or whatever."""
         self.active = False
 
+    @ignored_event
     def event_SYSWMEVENT(self, evt):
         """Handle SYSWMEVENT(13): System-specific/Window-Manager specific event."""
         pass
 
     def event_VIDEORESIZE(self, evt):
         """Handle VIDEORESIZE(16): The video window has been resized"""
-        pass
+        self.view.invalidate()
 
     def event_VIDEOEXPOSE(self, evt):
         """Handle VIDEOEXPOSE(17): Certain portions of the window must be redrawn."""
-        pass
+        self.view.invalidate()
 
+    @ignored_event
     def event_USEREVENT_0(self, evt):
         """Handle USEREVENT+0(24): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_1(self, evt):
         """Handle USEREVENT+1(25): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_2(self, evt):
         """Handle USEREVENT+2(26): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_3(self, evt):
         """Handle USEREVENT+3(27): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_4(self, evt):
         """Handle USEREVENT+4(28): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_5(self, evt):
         """Handle USEREVENT+5(29): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_6(self, evt):
         """Handle USEREVENT+6(30): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_7(self, evt):
         """Handle USEREVENT+7(31): Custom user event."""
         pass
 
+    @ignored_event
     def event_USEREVENT_DROPFILE(self, evt):
         """Handle USEREVENT_DROPFILE(4096): the user has drag-and-dropped a file into the
         window."""
         pass
 
+    # The event types that have a handler method called event_<NAME>. (The
+    # USEREVENT and DROPFILE handlers are added in _get_event_handlers.)
+    EVENT_NAMES = (
+        'NOEVENT', 'ACTIVEEVENT', 'KEYDOWN', 'KEYUP', 'MOUSEMOTION',
+        'MOUSEBUTTONDOWN', 'MOUSEBUTTONUP', 'JOYAXISMOTION', 'JOYBALLMOTION',
+        'JOYHATMOTION', 'JOYBUTTONDOWN', 'JOYBUTTONUP', 'QUIT', 'SYSWMEVENT',
+        'VIDEORESIZE', 'VIDEOEXPOSE',
+    )
+
+    # Event types that can pour in by the hundred per frame. When they're
+    # handled at all, they are merged down to one per frame (see coalesce).
+    COALESCED_EVENTS = ('MOUSEMOTION', 'JOYAXISMOTION')
+
     def _get_event_handlers(self):
         """Return an object that can be indexed by event type to access the event handler
         methods. The result of obj[evt_type] will be a bound method on self that can be
-        called. If self.support_dropfile is true (not the default) a dictionary is used.
-        This will show slightly worse performance. In the default case (support_dropfile is
-        False) a tuple is used.
-        """
-        _event_handlers = (
-            self.event_NOEVENT,       self.event_ACTIVEEVENT,     self.event_KEYDOWN,
-            self.event_KEYUP,         self.event_MOUSEMOTION,     self.event_MOUSEBUTTONDOWN,
-            self.event_MOUSEBUTTONUP, self.event_JOYAXISMOTION,   self.event_JOYBALLMOTION,
-            self.event_JOYHATMOTION,  self.event_JOYBUTTONDOWN,   self.event_JOYBUTTONUP,
-            self.event_QUIT,          self.event_SYSWMEVENT,      self.event_unsupported,
-            self.event_unsupported,   self.event_VIDEORESIZE,     self.event_VIDEOEXPOSE,
-            self.event_unsupported,   self.event_unsupported,     self.event_unsupported,
-            self.event_unsupported,   self.event_unsupported,     self.event_unsupported,
-            self.event_USEREVENT_0,   self.event_USEREVENT_1,     self.event_USEREVENT_2,
-            self.event_USEREVENT_3,   self.event_USEREVENT_4,     self.event_USEREVENT_5,
-            self.event_USEREVENT_6,   self.event_USEREVENT_7,
-
-        )
+        called.
+
+        This is a list with one entry for every possible event type (there
+        are `pygame.NUMEVENTS` of them), so finding a handler is a single
+        index operation, no matter what the event is. Types without a handler
+        method get `event_unhandled`. If self.support_dropfile is true (not
+        the default) dropped files go to `event_USEREVENT_DROPFILE`.
+
+        This also sets up the event filter. Event types whose handler does
+        nothing (is marked `@ignored_event`, and not overridden) are blocked,
+        so SDL throws them away instead of putting them in the queue. Override
+        a handler, and its events come through.
+        """
+        handled = {getattr(pygame, name): getattr(self, 'event_' + name)
+                   for name in self.EVENT_NAMES}
+
+        for n in range(8):
+            handled[pygame.USEREVENT + n] = getattr(self, 'event_USEREVENT_{}'.format(n))
 
         if self.support_dropfile:
-            handlers = {et:eh for et, eh in enumerate(_event_handlers)}
-            handlers[pygame.USEREVENT_DROPFILE] = self.event_USEREVENT_DROPFILE,
+            handled[pygame.DROPFILE] = self.event_USEREVENT_DROPFILE
+
+        handlers = [self.event_unhandled] * pygame.NUMEVENTS
+        for etype, handler in handled.items():
+            handlers[etype] = handler
+
+        allowed = [etype for etype, handler in handled.items()
+                   if etype != NOEVENT and not getattr(handler, 'ignored', False)]
+
+        if pygame.display.get_init():
+            pygame.event.set_blocked(None)
+            pygame.event.set_allowed(allowed)
+
+        self._coalesced = tuple(getattr(pygame, name) for name in self.COALESCED_EVENTS
+                                if getattr(pygame, name) in allowed)
+        if self._coalesced:
+            self.get_events = self.get_events_coalesced
         else:
-            handlers = _event_handlers
+            self.get_events = pygame.event.get
 
         return handlers
 
+    def get_events_coalesced(self):
+        """Return the events waiting in the queue, like `pygame.event.get`,
+        but with each of the COALESCED_EVENTS types merged down by `coalesce`.
+        The merged events come after all the others.
+        """
+        pygame_event_get = pygame.event.get
+        events = pygame_event_get(exclude=self._coalesced)
+        for etype in self._coalesced:
+            flood = pygame_event_get(etype, pump=False)
+            if flood:
+                events.extend(self.coalesce(flood))
+        return events
+
+    @staticmethod
+    def coalesce(events):
+        """Merge a frame's worth of motion events, all of one type, into as few
+        as possible. Mouse motions become a single motion to the last position,
+        with `rel` the total distance moved. Joystick axis motions keep only
+        the last position of each axis of each joystick.
+        """
+        if len(events) == 1:
+            return events
+
+        last = events[-1]
+        if last.type == MOUSEMOTION:
+            dx = sum(event.rel[0] for event in events)
+            dy = sum(event.rel[1] for event in events)
+            return [pygame.event.Event(MOUSEMOTION, dict(last.dict, rel=(dx, dy)))]
+
+        latest = {}
+        for event in events:
+            latest[event.dict.get('instance_id', event.dict.get('joy')), event.axis] = event
+        return list(latest.values())
+
+    def step(self):
+        """
+        Make exactly one trip around the event loop, without any waiting:
+        dispatch the pending events, run one model frame, and update the view.
+        This is for driving the game from a script (benchmarks, tests, etc.),
+        as fast as it will go.
+        """
+        handlers = self._event_handlers
+        for event in self.get_events():
+            handlers[event.type](event)
+
+        self.model.update_frame()
+        self.view.update()
+
     def run(self):
         """
         Run the main event loop, accepting events from the OS, dispatching them to the
         various handlers. Continue running until `self.active` is falsy. Each time
-        through the loop, call the model's `update_frame` method to notify it that
-        time has passed.
+        through the loop, call the model's `update_frame` method once for every
+        model frame that has come due, then update the view.
+
+        The view is passed an interpolation `alpha` between 0 and 1: how far
+        the real time has gotten between the last model frame and the next one.
         """
         handlers = self._event_handlers
 
         # Cache these function lookups.
         clock_tick = self.clock.tick
         model_update_frame = self.model.update_frame
-        pygame_event_get = pygame.event.get
+        view_update = self.view.update
+        pygame_event_get = self.get_events
+        perf_counter = time.perf_counter
 
         self.active = True
 
+        # `lag` is how much real time has passed that the model hasn't
+        # been told about yet.
+        lag = 0.0
+        previous = perf_counter()
+
         # An event handler will clear self.active to quit. Always
         # reload!
         while self.active:
             for event in pygame_event_get():
                 handlers[event.type](event)
 
-            # Call this once per frame.
-            model_update_frame()
+            now = perf_counter()
+            lag += now - previous
+            previous = now
+
             # Model or user could change framerate. Always reload it!
-            clock_tick(self.framerate_hz)
-            self.view.update()
+            frame_seconds = 1.0 / self.framerate_hz
+            catchup = self.max_catchup_frames
+
+            while lag >= frame_seconds:
+                if catchup == 0:
+                    # Too far behind. Let it go, rather than spiral.
+                    lag = 0.0
+                    break
+
+                model_update_frame()
+                lag -= frame_seconds
+                catchup -= 1
+
+            view_update(lag / frame_seconds)
+            clock_tick(self.render_hz or 0)
+
+        self.model.quit()
+
+    def run_profiled(self):
+        """
+        The same as `run`, but time the event handling, model updates, view
+        update and clock sleep of every trip around the loop, and record them
+        in `self.stats`.
+        """
+        handlers = self._event_handlers
+
+        # Cache these function lookups.
+        clock_tick = self.clock.tick
+        model_update_frame = self.model.update_frame
+        view_update = self.view.update
+        pygame_event_get = self.get_events
+        perf_counter = time.perf_counter
+        record = self.stats.record
+
+        self.active = True
+
+        lag = 0.0
+        previous = perf_counter()
+
+        while self.active:
+            t0 = perf_counter()
+            for event in pygame_event_get():
+                handlers[event.type](event)
+
+            t1 = perf_counter()
+            lag += t1 - previous
+            previous = t1
+
+            frame_seconds = 1.0 / self.framerate_hz
+            catchup = self.max_catchup_frames
+
+            while lag >= frame_seconds:
+                if catchup == 0:
+                    lag = 0.0
+                    break
+
+                model_update_frame()
+                lag -= frame_seconds
+                catchup -= 1
+
+            t2 = perf_counter()
+            view_update(lag / frame_seconds)
+            t3 = perf_counter()
+            clock_tick(self.render_hz or 0)
+            t4 = perf_counter()
+
+            record(t1 - t0, t2 - t1, t3 - t2, t4 - t3)
 
         self.model.quit()
 
@@ -496,10 +1782,36 @@ class PygameView:
 
     ########################################################################
 
-    This class doesn't know much, just yet.
+    This class doesn't know much, just yet. It draws a background and
+    whatever sprite groups it is given.
+
+    The background is either a single surface (`set_background`), or a
+    scrolling Stage (`set_stage`). With a Camera (`set_camera`), the view
+    shows the part of the world the camera is looking at; without one,
+    world coordinates are screen coordinates.
+
+    By default, the whole window is redrawn and sent to the display every
+    frame. If `dirty_rects` is true, only the parts of the window that
+    changed - where a sprite moved from and to, or changed its picture - are
+    redrawn and sent (see `draw_dirty`). That's a lot less work when most of
+    the screen is just background. A full redraw still happens whenever the
+    background changes, the camera moves, or `invalidate` is called.
+
+    If `headless` is true, there is no window at all. SDL's "dummy" video
+    driver is used (images still have to be converted to *some* display
+    format), unless SDL_VIDEODRIVER already names one, and `update` draws
+    nothing. This is for running the model by itself - see `run_headless`.
+    The display is only initialized once per process, so the first view
+    decides the driver for every view after it.
+
+    To record what's drawn, `start_capture` (see FrameCapture). Then every
+    `update` is captured. A headless view draws too, while it's capturing:
+    its "screen" is just a surface in memory, so that's offscreen rendering,
+    as fast as the game can go.
     """
 
-    def __init__(self, *, resolution=None, resource_manager=None):
+    def __init__(self, *, resolution=None, resource_manager=None, dirty_rects=False,
+            headless=False):
         """
         Create a View object for Pygame. This will handle collecting and
         dispatching events, creating and updating a graphics window, and
@@ -513,11 +1825,52 @@ class PygameView:
 
         self.resolution = resolution
         self.resource_manager = resource_manager
+        self.dirty_rects = dirty_rects
+        self.headless = headless
 
-        pygame.init()
+        # SDL picks the video driver when the display is initialized, from
+        # the environment. Only ask for "dummy" while that happens, and not
+        # if a driver was already chosen, so the rest of the process sees
+        # the environment it started with.
+        saved_driver = os.environ.get('SDL_VIDEODRIVER')
+        if headless and saved_driver is None:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
 
-        self.screen = pygame.display.set_mode(resolution)
+        try:
+            # A small mixer buffer, so sound effects start right when they're
+            # played instead of a noticeable moment later.
+            pygame.mixer.pre_init(buffer=512)
+            pygame.init()
+
+            self.screen = pygame.display.set_mode(resolution)
+        finally:
+            if saved_driver is None:
+                os.environ.pop('SDL_VIDEODRIVER', None)
+
+        # Sound effects by name, and the channels to play them on. There's
+        # no sound if there's no audio device (or no window).
+        self.sounds = {}
+        self.channels = None
+        if not headless and pygame.mixer.get_init():
+            self.channels = ChannelPool()
         self.background = None
+        self.stage = None
+        self.camera = None
+        self.capture = None
+        self.sprite_groups = []
+
+        # Functions that draw on top of everything else, like a stats
+        # display. Each one is called with the screen and returns the rect
+        # it drew. See `static_overlay`, for ones that never change.
+        self.overlays = []
+
+        # What each sprite was drawn with last frame - (image, screen rect) -
+        # and the rect each overlay drew. And whether the next update has to
+        # redraw everything.
+        self._drawn = {}
+        self._overlay_rects = {}
+        self._full_redraw = True
+        self._drawn_offset = (0, 0)
 
         self.set_background(self.screen)
 
@@ -534,9 +1887,279 @@ class PygameView:
         if self.background != bg:
             self.background = bg
             self.screen.blit(bg, (0,0))
+            self.invalidate()
+
+    def set_stage(self, stage, *, lookahead=None):
+        """Use `stage` (a Stage) as the background, streamed in as the
+        camera moves (see StageBackground). None goes back to `background`.
+        """
+        if stage is None:
+            self.stage = None
+        else:
+            self.stage = StageBackground(stage, self.resource_manager, lookahead=lookahead)
+        self.invalidate()
+
+    def set_camera(self, camera):
+        """Look at the world through `camera` (a Camera, or None)."""
+        self.camera = camera
+        self.invalidate()
+
+    def start_capture(self, path, *, format='png', block=None, **kwargs):
+        """Start recording every frame to `path` (see FrameCapture for the
+        rest of the arguments). Unless `block` says otherwise, a headless
+        view records every frame, and a windowed one would rather skip a
+        frame than slow the game down.
+        """
+        if block is None:
+            block = self.headless
+        self.capture = FrameCapture(self.screen, path, format=format, block=block, **kwargs)
+        return self.capture
+
+    def stop_capture(self):
+        """Stop recording, and wait for the last frames to be written.
+        Returns the FrameCapture, for its counts.
+        """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        return capture
+
+    def get_offset(self, alpha=1.0):
+        """Return the world position at the top-left of the screen."""
+        if self.camera is None:
+            return (0, 0)
+        return self.camera.offset(alpha)
+
+    def draw_background(self, offset, area=None):
+        """Draw the background (the part of it in screen rect `area`, if
+        given) for a camera at `offset`.
+        """
+        screen = self.screen
+        if self.stage is not None:
+            self.stage.draw(screen, offset, area)
+        elif self.background is not screen:
+            if area is None:
+                screen.blit(self.background, (0, 0))
+            else:
+                screen.blit(self.background, area, area)
 
-    def update(self):
-        pygame.display.update()
+    def invalidate(self):
+        """Force the next update to redraw the whole window. Call this when
+        the window contents were lost (VIDEOEXPOSE) or resized.
+        """
+        self._full_redraw = True
+
+    def show_progress(self, progress, *, interval=1/60):
+        """Draw a loading bar, and keep it up to date, until `progress()` - a
+        function that returns (done, total), like
+        `PygameResourceManager.prefetch_progress` - says everything is done.
+        The window stays alive, and the user can see something happening,
+        while the assets load in the background.
+        """
+        if self.headless:
+            return
+
+        screen = self.screen
+        width, height = screen.get_size()
+        bar = pygame.Rect(width // 4, height // 2 - 6, width // 2, 12)
+
+        while True:
+            done, total = progress()
+
+            screen.fill(BLACK)
+            pygame.draw.rect(screen, DIM_GRAY, bar, 1)
+            if total:
+                filled = bar.inflate(-4, -4)
+                filled.width = filled.width * done // total
+                pygame.draw.rect(screen, WHITE, filled)
+            pygame.display.update()
+
+            # Keep the OS from deciding the window is hung.
+            pygame.event.pump()
+
+            if done >= total:
+                break
+            time.sleep(interval)
+
+        self.invalidate()
+
+    def play_sound(self, name, priority=0):
+        """Play the sound effect called `name`, if there is one, and if there
+        is sound at all. See ChannelPool for what `priority` does.
+        """
+        if self.channels is not None:
+            self.channels.play(self.sounds.get(name), priority)
+
+    def add_sprites(self, group):
+        """Register a sprite group with the view. Registered groups are drawn,
+        in the order they were added, every time the view is updated.
+        """
+        self.sprite_groups.append(group)
+
+    def draw(self, alpha=1.0):
+        """Redraw the whole screen: background first, then the sprite groups.
+        Override this (and call super) to draw extra things.
+        """
+        offset = self._drawn_offset = self.get_offset(alpha)
+        self.draw_background(offset)
+        self.draw_sprites(alpha, offset)
+
+    def draw_dirty(self, alpha=1.0):
+        """Redraw only what changed since the last frame, and return the list
+        of screen rects that changed.
+
+        A sprite has changed if it is new, or gone, or drawn with a different
+        image or in a different place than last time. The background is
+        copied over everywhere a changed sprite was or is, and then whatever
+        overlaps those places is drawn again, in the usual order: changed
+        sprites whole, and unchanged ones only the part that was erased.
+        Unchanged sprites away from all that aren't touched at all.
+
+        Overlays can't tell us whether they changed, so they are redrawn
+        every frame, unless they are marked with `static_overlay`. Those
+        only have to be redrawn where something under them changed.
+        """
+        screen = self.screen
+        offset = self._drawn_offset
+        old = self._drawn
+        placed = self.place_sprites(alpha, offset)
+
+        dirty = []
+        changed = set()
+        for sprite, image, rect in placed:
+            last = old.pop(sprite, None)
+            if last is None:
+                dirty.append(rect)
+                changed.add(sprite)
+            elif last[0] is not image or last[1] != rect:
+                dirty.append(last[1])
+                dirty.append(rect)
+                changed.add(sprite)
+
+        # Whatever is left over belongs to sprites that went away.
+        dirty.extend(rect for image, rect in old.values())
+
+        overlay_rects = self._overlay_rects
+        for overlay in self.overlays:
+            if overlay in overlay_rects and not getattr(overlay, 'static', False):
+                dirty.append(overlay_rects[overlay])
+
+        # Erase and redraw each part of the screen once: drawing a sprite
+        # twice in the same place would blend its see-through edges twice.
+        dirty = self.merge_rects(dirty, screen.get_rect())
+        for rect in dirty:
+            self.draw_background(offset, rect)
+
+        blit = screen.blit
+        for sprite, image, rect in placed:
+            if sprite in changed:
+                blit(image, rect)
+            else:
+                for n in rect.collidelistall(dirty):
+                    area = rect.clip(dirty[n])
+                    blit(image, area, area.move(-rect.x, -rect.y))
+        self._drawn = {sprite: (image, rect) for sprite, image, rect in placed}
+
+        drawn = []
+        for overlay in self.overlays:
+            last = overlay_rects.get(overlay)
+            if last is None or not getattr(overlay, 'static', False):
+                overlay_rects[overlay] = overlay(screen)
+                drawn.append(overlay_rects[overlay])
+            else:
+                for n in last.collidelistall(dirty):
+                    screen.set_clip(dirty[n])
+                    overlay(screen)
+                screen.set_clip(None)
+
+        return dirty + drawn
+
+    @staticmethod
+    def merge_rects(rects, bounds):
+        """Return `rects`, cut down to `bounds`, with any that overlap joined
+        together, so none of the rects returned overlap.
+        """
+        merged = []
+        for rect in rects:
+            rect = bounds.clip(rect)
+            if not rect:
+                continue
+            n = rect.collidelist(merged)
+            while n != -1:
+                rect.union_ip(merged.pop(n))
+                n = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def place_sprites(self, alpha=1.0, offset=(0, 0)):
+        """Work out where every sprite in the registered groups goes on the
+        screen, without drawing anything. Returns a list of (sprite, image,
+        screen rect), in drawing order.
+
+        Sprites that have a `prev_pos` (their position one model frame ago)
+        are drawn `alpha` of the way from there to their current `rect`. This
+        keeps motion smooth when the view runs faster than the model.
+
+        Sprites are in world coordinates; `offset` is the world position of
+        the top-left of the screen.
+        """
+        placed = []
+        ox, oy = offset
+
+        for group in self.sprite_groups:
+            for sprite in group:
+                image = sprite.image
+                rect = sprite.rect
+                prev_pos = getattr(sprite, 'prev_pos', None)
+
+                if prev_pos is None or alpha >= 1.0:
+                    pos = (rect.x - ox, rect.y - oy)
+                else:
+                    x, y = prev_pos
+                    pos = (round(x + (rect.x - x) * alpha) - ox,
+                           round(y + (rect.y - y) * alpha) - oy)
+                placed.append((sprite, image, image.get_rect(topleft=pos)))
+
+        return placed
+
+    def draw_sprites(self, alpha=1.0, offset=(0, 0)):
+        """Draw every sprite in the registered groups (see `place_sprites`),
+        then the overlays, which are in screen coordinates. Remembers what
+        was drawn where, for `draw_dirty`.
+        """
+        screen = self.screen
+        blit = screen.blit
+        placed = self.place_sprites(alpha, offset)
+
+        for sprite, image, rect in placed:
+            blit(image, rect)
+        self._drawn = {sprite: (image, rect) for sprite, image, rect in placed}
+
+        self._overlay_rects = {overlay: overlay(screen) for overlay in self.overlays}
+
+    def update(self, alpha=1.0):
+        """Draw the screen and send it to the display. The `alpha` is passed
+        through to `draw_sprites`.
+        """
+        capture = self.capture
+        if self.headless and capture is None:
+            return
+
+        if self.stage is not None:
+            self.stage.update(self.camera.rect if self.camera is not None else self.screen.get_rect())
+
+        if self.headless:
+            self.draw(alpha)
+        elif (self.dirty_rects and not self._full_redraw and
+                self.get_offset(alpha) == self._drawn_offset):
+            pygame.display.update(self.draw_dirty(alpha))
+        else:
+            self._full_redraw = False
+            self.draw(alpha)
+            pygame.display.update()
+
+        if capture is not None:
+            capture.add(self.screen)
 
 #*************************************************************************
 #   CLASSES
@@ -547,20 +2170,150 @@ class GrapevineController(PygameController):
         super().__init__(*args, **kwargs)
 
 class GrapevineResourceManager(PygameResourceManager):
+    CHARACTERS = ('boonrit', 'shit_clown', 'jack_scrapper')
+    BUNDLE = 'img.bundle'
+
     def get_image_path(self, name):
         return self.get_path('img', name)
 
     def get_music_path(self, name):
         return self.get_path('music', name)
 
+    def get_sound_path(self, name):
+        return self.get_path('audio', name)
+
+    def load_sound_bank(self):
+        """Load every sound effect in audio/ (if there is such a directory).
+        See `load_sounds`.
+        """
+        top = self.get_sound_path('')
+        if not os.path.isdir(top):
+            return {}
+
+        return self.load_sounds(sorted(name for name in os.listdir(top)
+                                       if name.lower().endswith(('.wav', '.ogg'))))
+
+    def load_frame_table(self, characters=None):
+        """Load every animation frame for the given characters (default: all
+        of CHARACTERS) and return a dictionary keyed by (character, state,
+        variant). See `parse_frame_name` for how the keys are made.
+
+        The first call packs the frames into the atlas (see
+        `build_character_atlas`) and decodes them. After that, the
+        characters just look their frames up in the table - there is no
+        file reading or PNG decoding in the middle of a fight. The frames are
+        pinned in the image cache, so they are never evicted, and their
+        collision masks and boxes (see `get_bounding_boxes`) are made now too.
+        Calling this again, for every new game, just hands out the same
+        frames again.
+        """
+        if characters is None:
+            characters = self.CHARACTERS
+
+        self.build_character_atlas()
+        table = {}
+
+        for name in self.list_character_images():
+            key = self.parse_frame_name(os.path.basename(name))
+            if key[0] in characters:
+                table[key] = frame = self.pin(name)
+                self.get_bounding_boxes(frame)
+
+        return table
+
+    def build_character_atlas(self, **kwargs):
+        """Pack every image in img/chars into the atlas (once - see
+        `build_atlas`). `load_frame_table` calls this first, so the frame
+        table is made of atlas subsurfaces.
+        """
+        return self.build_atlas(self.list_character_images(), **kwargs)
+
+    def list_images(self):
+        """Return the names (as used by get_image) of every PNG and JPEG file
+        under img/, including the subdirectories. These are what goes in
+        the bundle.
+        """
+        top = self.get_image_path('')
+        names = []
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                    names.append(os.path.relpath(os.path.join(dirpath, filename), top))
+
+        return sorted(names)
+
+    def build_image_bundle(self):
+        """Bundle every image in img/ into the game's bundle file, which is
+        loaded automatically from then on. Returns the bundle index.
+        """
+        return self.build_bundle(self.get_path(self.BUNDLE), self.list_images())
+
+    def list_character_images(self):
+        """Return the image names (as used by get_image) of every PNG file
+        in img/chars. If there's a bundle, this comes from the bundle's
+        index, without looking in the directory.
+        """
+        if self._bundle_index:
+            return sorted(name for name in self._bundle_index
+                          if os.path.dirname(name) == 'chars' and name.endswith('.png'))
+
+        names = []
+
+        with os.scandir(self.get_image_path('chars')) as diriter:
+            for entry in diriter:
+                if entry.is_file() and entry.name.endswith('.png'):
+                    names.append(os.path.join('chars', entry.name))
+
+        return sorted(names)
+
+    @staticmethod
+    def parse_frame_name(filename):
+        """Split a character image filename into a (character, state, variant)
+        key. The files are named like `character[-state][-variant].png`:
+
+            boonrit-3.png           -> ('boonrit', 'idle', 3)
+            boonrit-attack-1.png    -> ('boonrit', 'attack', 1)
+            boonrit-held-stun.png   -> ('boonrit', 'held-stun', 1)
+
+        A missing state means 'idle', and a missing variant means 1.
+        """
+        parts = os.path.splitext(filename)[0].split('-')
+        character = parts.pop(0)
+
+        variant = 1
+        if parts and parts[-1].isdigit():
+            variant = int(parts.pop())
+
+        state = '-'.join(parts) if parts else 'idle'
+        return (character, state, variant)
+
+# Stage 1 is four screens wide. For now, every chunk is the same picture.
+STAGE_1 = Stage(('background-1.png',) * 4, (SCREEN_WIDTH, SCREEN_HEIGHT))
+
 class GrapevineView(PygameView):
+    MUSIC = 'looperman-l-1951920-0106474-tofcix-piano-1.wav'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         pygame.display.set_caption("Grapevine")
 
-        bg = self.resource_manager.get_image('background-1.png')
-        self.set_background(bg)
+        # The HUD stays put while the stage scrolls under it, so it is
+        # drawn on top, every full redraw - and in dirty-rect mode, wherever
+        # something under it changed. It's drawn once, here, and after that
+        # just blitted. The empty parts are see-through because of the color
+        # key, which is cheaper to blit than an alpha channel.
+        hud = pygame.Surface(self.screen.get_size())
+        self.hud_rect = self.draw_hud(hud)
+        self.hud = hud.subsurface(self.hud_rect).copy()
+        self.hud.set_colorkey(BLACK)
+        self.overlays.append(self.blit_hud)
+
+        # Decode all the sound effects now, and start the music.
+        if self.channels is not None:
+            self.sounds = self.resource_manager.load_sound_bank()
+            self.resource_manager.play_music(self.MUSIC)
         #background_image = 'res' + os.sep + 'images' + os.sep + 'bg-level-1-1-1.jpg'
         #pygame.image.load(os.path.join("res","images","bg-level-1-1-1.jpg")).convert()
         #bg = pygame.image.load("bg-level-1-1-1.jpg").convert()
@@ -568,36 +2321,381 @@ class GrapevineView(PygameView):
         #font_hero_name = pygame.font.SysFont("monospace", 15)
         pygame.display.flip()
 
+    def draw_hud(self, surface):
+        pygame.draw.rect(surface, DIM_GRAY, (20, 20, 250, 30))
+        pygame.draw.rect(surface, DIM_GRAY, (20, 55, 250, 5))
+        pygame.draw.rect(surface, DIM_GRAY, (275, 10, 70, 70))
+        #pygame.font.Font.render("Boonrit")
+        return pygame.Rect(20, 10, 325, 70)
+
+    @static_overlay
+    def blit_hud(self, surface):
+        return surface.blit(self.hud, self.hud_rect)
+
+
+"""
+**************************************************************************
+    COMBAT STATES
+
+    Every character is always in exactly one combat state: idle, attacking,
+    jumping, blocking, stunned, held, or knocked down. Each state has a
+    duration in frames (0 means "until something else happens"), a state to
+    go to when the duration runs out, an animation frame, and a table of
+    which events (key presses, hits) move it to which other state.
+**************************************************************************
+"""
+
+# Events that can move a character from one state to another. NO_INPUT
+# means "no attack/jump/block key is held down this frame."
+COMBAT_EVENTS = ('no_input', 'attack', 'jump', 'block', 'stun', 'grab', 'knockdown')
+
+def _jump_path(remaining):
+    """Up for the first half of the jump, down for the second."""
+    return (0, -3) if remaining >= 30 else (0, 3)
+
+def _held_path(remaining):
+    """Shoved away on the frame you get let go."""
+    return (40, 0) if remaining == 0 else (0, 0)
+
+# name: (duration, frame, can_move, expire_to, path, transitions)
+#
+# `frame` is the (state, variant) to look up in the frame table. A variant
+# of None means "pick by hp tier" (see HP_TIERS). `path` is a function from
+# frames-remaining to a (dx, dy) move for that frame, or None.
+COMBAT_STATES = {
+    'idle': (0, ('idle', None), True, 'idle', None, {
+        'attack': 'attack', 'jump': 'jump', 'block': 'block',
+        'stun': 'stun', 'grab': 'held', 'knockdown': 'knockdown'}),
+    'attack': (20, ('attack', 1), False, 'idle', None, {
+        'stun': 'stun', 'grab': 'held', 'knockdown': 'knockdown'}),
+    'jump': (60, ('idle', 3), True, 'idle', _jump_path, {
+        'stun': 'jumping-stun', 'knockdown': 'knockdown'}),
+    'block': (0, ('block', 1), False, 'idle', None, {
+        'no_input': 'idle', 'attack': 'attack', 'jump': 'jump',
+        'grab': 'held', 'knockdown': 'knockdown'}),
+    'stun': (30, ('stun', 1), False, 'idle', None, {
+        'grab': 'held-stun', 'knockdown': 'knockdown-stun'}),
+    'held': (60, ('held', 1), False, 'idle', _held_path, {
+        'stun': 'held-stun'}),
+    'held-stun': (30, ('held-stun', 1), False, 'idle', None, {}),
+    'jumping-stun': (30, ('jumping-stun', 1), False, 'idle', None, {}),
+    'knockdown': (60, ('knockdown-stun', 1), False, 'idle', None, {
+        'stun': 'knockdown-stun'}),
+    'knockdown-stun': (30, ('knockdown-stun', 1), False, 'idle', None, {}),
+}
+
+class CombatStateMachine:
+    """
+    The COMBAT_STATES description "compiled" into flat tuples indexed by
+    state number, so that a frame of combat is a couple of tuple lookups
+    instead of a pile of `if` statements. States and events are numbered in
+    the order they are listed.
+
+        duration[state]             frames the state lasts (0: no limit)
+        expire[state]               state to go to when the duration runs out
+        frame[state]                (state, variant) key into the frame table
+        can_move[state]             may the arrow keys move the character?
+        path[state]                 None, or a tuple of (dx, dy) indexed by
+                                    frames remaining
+        transitions[state][event]   next state, or -1 to ignore the event
+
+    Heroes step through this one frame at a time (see Character.step_state).
+    The VillainStore steps a whole crowd at once, using the same tables.
+    """
+
+    def __init__(self, states, events):
+        names = list(states)
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(names)}
+        self.events = {name: i for i, name in enumerate(events)}
+
+        index = self.index
+        self.duration = tuple(states[name][0] for name in names)
+        self.frame = tuple(states[name][1] for name in names)
+        self.can_move = tuple(states[name][2] for name in names)
+        self.expire = tuple(index[states[name][3]] for name in names)
+
+        paths = []
+        for name in names:
+            duration, path = states[name][0], states[name][4]
+            paths.append(None if path is None else tuple(path(r) for r in range(duration + 1)))
+        self.path = tuple(paths)
+
+        self.transitions = tuple(
+            tuple(index[states[name][5][event]] if event in states[name][5] else -1
+                  for event in events)
+            for name in names)
+
+COMBAT = CombatStateMachine(COMBAT_STATES, COMBAT_EVENTS)
+
+IDLE, ATTACK, JUMP, BLOCK = (COMBAT.index[name] for name in ('idle', 'attack', 'jump', 'block'))
+(NO_INPUT, ATTACK_INPUT, JUMP_INPUT, BLOCK_INPUT,
+ STUN_HIT, GRAB_HIT, KNOCKDOWN_HIT) = range(len(COMBAT_EVENTS))
+
+# hp at or below each of these is the next tier down. Tier 0 is dead, tier
+# 4 is healthy. See bisect_left / numpy.searchsorted.
+HP_TIERS = (0, 20, 60, 90)
+HP_TIER_COLORS = (None, DEEP_RED, DARK_ORANGE, LIME_GREEN, None)
+
+"""
+**************************************************************************
+    HITBOXES AND HURTBOXES
+
+    An attack only hurts on some frames of its animation - the "active"
+    frames. Before them is the wind-up, and after them the recovery, when
+    the fist is on its way out or back and can't hurt anybody.
+
+    Each character class says where its attacks hurt in `HITBOXES`:
+
+        {state name: ((first, end, boxes), ...)}
 
-class Character(pygame.sprite.Sprite):
+    where the boxes are active from frame `first` of the state up to (but
+    not including) frame `end`, counting from 0 on the frame the state is
+    entered. Each box is (x, y, w, h, damage, chip): a rectangle relative to
+    the top-left of the frame (facing right), the damage it does, and the
+    damage it does to someone who is blocking.
+
+    Where a character can BE hurt is its `HURTBOXES`: a tuple of (x, y, w, h)
+    rectangles, also relative to the frame and facing right. None means
+    "wherever the frame isn't transparent." Hurtboxes have to be inside the
+    character's rect.
+
+    The CombatEngine tests them against each other.
+**************************************************************************
+"""
+
+def compile_hitboxes(hitboxes):
+    """Turn a HITBOXES description into a tuple indexed by state number.
+    Each entry is None (no attacks in that state) or a tuple, indexed by
+    frames into the state, of the boxes active on that frame.
+    """
+    frames = [None] * len(COMBAT.names)
+    for name, windows in hitboxes.items():
+        table = [()] * max(end for first, end, boxes in windows)
+        for first, end, boxes in windows:
+            for elapsed in range(first, end):
+                table[elapsed] += tuple(boxes)
+        frames[COMBAT.index[name]] = tuple(table)
+    return tuple(frames)
+
+class CharacterSchema(type):
+    """
+    The metaclass of Character: the class of the Character classes. It turns
+    each class's `FIELDS` - a tuple of (name, default) pairs - into
+
+      - `__slots__` for the new field names, so each instance keeps those
+        fields in a fixed-size array of slots instead of a dictionary, and
+      - `defaults`, a dictionary of name -> default for every field the
+        class has, including the ones it inherits.
+
+    It also compiles the class's `HITBOXES`, if it has its own, into
+    `hitbox_frames` (see compile_hitboxes).
+
+    A subclass can list an inherited field again just to change its
+    default; that doesn't make a new slot.
+
+    (pygame's Sprite doesn't use slots itself, so every character still has
+    a small `__dict__`, holding the set of groups the sprite is in. Also,
+    the same name can't be both a slot and a class attribute, so defaults
+    live in `defaults` and are filled in by the constructor.)
+    """
+
+    def __new__(mcls, name, bases, namespace):
+        defaults = {}
+        for base in reversed(bases):
+            defaults.update(getattr(base, 'defaults', {}))
+
+        fields = namespace.get('FIELDS', ())
+        new_fields = tuple(field for field, _ in fields if field not in defaults)
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + new_fields
+
+        cls = super().__new__(mcls, name, bases, namespace)
+        defaults.update(fields)
+        cls.defaults = defaults
+        cls.field_names = tuple(defaults)
+
+        if 'HITBOXES' in namespace:
+            cls.hitbox_frames = compile_hitboxes(namespace['HITBOXES'])
+        return cls
+
+class Character(pygame.sprite.Sprite, metaclass=CharacterSchema):
     """
     Character is the root of the game class tree. A character can be a
     hero or villain. A character is an object that displays and updates
     some kind of sprite on the screen, moves around, performs actions,
     etc.
+
+    What a character knows about itself is declared in `FIELDS`, and
+    subclasses can add fields or change the defaults (see CharacterSchema).
+    The constructor takes the fields in order, or by name, and anything not
+    given gets its default. To make lots of the same thing, make one and
+    `clone` it.
+
+    The `frames` class attribute holds the animation frame table built by
+    `GrapevineResourceManager.load_frame_table`. It is shared by every
+    character, and is keyed by (image_prefix, state, variant). The frames
+    all face right; `facing` is 1 for right, -1 for left, and the flipped
+    (or tinted) frames come from the shared `variants` cache.
+
+    `state` and `state_timer` are the character's combat state (a COMBAT
+    state number) and the frames left in it. Where its attacks land and
+    where it can be hit are its `HITBOXES` and `HURTBOXES` (see above), and
+    it can only hit characters on another `team`.
     """
 
-    def __init__(self, **kwargs):
+    FIELDS = (
+        ('name', None),
+        ('level', 1),
+        ('speed', 0),
+        ('hp', 0),
+        ('stamina', 0),
+        ('fear', 0),
+        ('image_prefix', None),
+        ('state', IDLE),
+        ('state_timer', 0),
+        ('prev_pos', None),
+        ('spatial_index', None),
+        ('facing', 1),
+    )
+
+    __slots__ = ('image', 'rect')
+
+    HITBOXES = {}
+    HURTBOXES = None
+
+    # How wide the character itself is: its idle frames. Wider frames, like
+    # a punch, stick out the front (see `get_body`).
+    BODY_WIDTH = 30
+
+    frames = {}
+    variants = VariantCache()
+    image_dir = os.path.join('res', 'img', 'chars')
+    team = 0
+
+    # Until a character has a frame of its own, it shows this. It is made
+    # once, the first time it's needed, and shared.
+    _blank_image = None
+
+    def __init__(self, *args, **kwargs):
         """
-        Any attributes that are passed in by name will be added to the
-        object.
+        Fields can be passed in order (see `field_names`) or by name. The
+        rest get their defaults.
         """
         super().__init__()
 
-        # Import any attributes specified in the kwargs
-        for attr,val in kwargs.items():
-            setattr(self, attr, val)
+        names = self.field_names
+        if len(args) > len(names):
+            raise TypeError('Too many arguments for {}'.format(type(self).__name__))
+
+        values = dict(self.defaults)
+        values.update(zip(names, args))
+        for name, value in kwargs.items():
+            if name not in values:
+                raise TypeError('{} has no field {!r}'.format(type(self).__name__, name))
+            values[name] = value
+
+        for name, value in values.items():
+            setattr(self, name, value)
 
         # Take care of some pygame-specific data
-        self.image = pygame.Surface(DEFAULT_SURFACE_SIZE)
-        self.rect = self.image.get_rect()
-        self.surf = pygame.Surface(DEFAULT_SURFACE_SIZE)
+        if Character._blank_image is None:
+            Character._blank_image = pygame.Surface(DEFAULT_SURFACE_SIZE)
+        self.image = Character._blank_image
+        self.rect = pygame.Rect((0, 0), DEFAULT_SURFACE_SIZE)
+
+    def clone(self, **changes):
+        """Return a new character just like this one, except for any fields
+        given in `changes`. The clone is not in any sprite groups, and has
+        its own copy of the rect.
+        """
+        cls = type(self)
+        other = cls.__new__(cls)
+        self._clone_into(other, changes)
+        return other
+
+    def _clone_into(self, other, changes):
+        pygame.sprite.Sprite.__init__(other)
+
+        for name in self.field_names:
+            value = changes.pop(name) if name in changes else getattr(self, name)
+            setattr(other, name, value)
 
-        self.image_dir = os.path.join(*'res/img/chars'.split('/'))
+        if changes:
+            raise TypeError('{} has no field {!r}'.format(type(self).__name__, next(iter(changes))))
+
+        other.prev_pos = None
+        other.spatial_index = None
+        other.image = self.image
+        other.rect = self.rect.copy()
 
     def get_name(self):
         raise NotImplementedError
 
+    def kill(self):
+        super().kill()
+        if self.spatial_index is not None:
+            self.spatial_index.remove(self)
+
+    def enter_state(self, state, duration=None):
+        """Switch to combat `state`, for `duration` frames (default: the
+        state's own duration).
+        """
+        self.state = state
+        self.state_timer = COMBAT.duration[state] if duration is None else duration
+
+    def handle_event(self, event, duration=None):
+        """Look up where `event` takes the current state, and go there. Events
+        the current state doesn't care about are ignored.
+        """
+        state = COMBAT.transitions[self.state][event]
+        if state >= 0:
+            self.enter_state(state, duration)
+
+    def step_state(self):
+        """Count one frame off the state timer: follow the state's path, and
+        when the time runs out, move on to the state's expire state.
+        """
+        timer = self.state_timer
+        if timer:
+            timer -= 1
+            state = self.state
+
+            path = COMBAT.path[state]
+            if path is not None:
+                self.rect.move_ip(path[timer])
+
+            if timer == 0:
+                self.enter_state(COMBAT.expire[state])
+            else:
+                self.state_timer = timer
+
+    def get_hitboxes(self):
+        """Return the hitboxes that are active on this frame of the current
+        state, as they are listed in HITBOXES.
+        """
+        state = self.state
+        table = self.hitbox_frames[state]
+        if table is not None:
+            elapsed = COMBAT.duration[state] - self.state_timer
+            if elapsed < len(table):
+                return table[elapsed]
+        return ()
+
+    def get_body(self):
+        """Return the rect of the character's body, leaving out whatever
+        the current frame sticks out the front. Unlike `rect`, it doesn't
+        move when the character punches.
+        """
+        rect = self.rect
+        body = pygame.Rect(rect.x, rect.y, self.BODY_WIDTH, rect.height)
+        if self.facing < 0:
+            body.right = rect.right
+        return body
+
+    def get_frame(self, state='idle', variant=1):
+        """Look up one of this character's animation frames in the frame table."""
+        return self.frames[self.image_prefix, state, variant]
+
     def load_images(self, prefix=None):
         if prefix is None:
             if self.image_prefix is not None:
@@ -625,274 +2723,434 @@ class Character(pygame.sprite.Sprite):
 **************************************************************************
     CREATING THE HERO CLASS
 
-    Values: NAME, SPEED, LEVEL, HP, STAMINA, FEAR
+    Values: NAME, LEVEL, SPEED, HP, STAMINA, FEAR
     Format: player = Hero(str, int, int, int, int, int)
 
     Example:
-    heroBoonrit = Hero("Boonrit", 30, 1, 10000, 50, 20)
+    heroBoonrit = Hero("Boonrit", 1, 3, 10000, 50, 20)
 **************************************************************************
 """
 class Hero(Character):
-    def __init__(self, name, level, speed, hp, stamina, fear, blocking, jumping_cooldown, attacking_cooldown, held_cooldown, knockdown_cooldown, stun_cooldown, jumping_timer, attacking_timer, held_timer, knockdown_timer, stun_timer, grabbed_cooldown, grabbed_timer):
-        super().__init__()
-        self.name = name
-        self.speed = speed
-        self.level = level
-        self.hp = hp
-        self.stamina = stamina
-        self.fear = fear
-        self.blocking = blocking
-        self.jumping_cooldown = jumping_cooldown
-        self.jumping_timer = jumping_timer
-        self.attacking_cooldown = attacking_cooldown
-        self.attacking_timer = attacking_timer
-        self.held_cooldown = held_cooldown
-        self.held_timer = held_timer
-        self.knockdown_cooldown = knockdown_cooldown
-        self.knockdown_timer = knockdown_timer
-        self.stun_cooldown = stun_cooldown
-        self.stun_timer = stun_timer
+
+    # The punch lands on frames 4 to 7 of the 20-frame attack, out where the
+    # fist is in the attack frame.
+    HITBOXES = {
+        'attack': ((4, 8, ((30, 20, 40, 25, 100, 10),)),),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.image_prefix is None:
+            self.image_prefix = self.name.lower()
 
     def jump(self):
-        #if self.attacking_cooldown == False and self.held_cooldown == False and self.stun_cooldown == False and self.knockdown_cooldown == False:
-        self.jumping_cooldown == True
-        ticks = 60
+        self.handle_event(JUMP_INPUT)
 
-    def held(self, enemy):
-        #for villan in near_hero_list:
-        pass
+    def held(self, enemy, duration=None):
+        self.handle_event(GRAB_HIT, duration)
 
     def update(self, pressed_keys):
 
-        #if self.held_cooldown:
         #for villan in near_hero_list:
-        #    if villan.grabbing_cooldown == True:
-        #        self.held_cooldown == True
+        #    if villan.grab(self):
+        #        self.held(villan)
         #        self.rect.x = (villan.rect.x + 30)
         #        self.rect.y = villan.rect.y
         #        break
 
-        if self.held_cooldown == True:
-            self.held_timer -= 1
-            if self.held_timer == 0:
-                self.held_cooldown = False
-                self.rect.x += 40
-
-        if self.jumping_cooldown == True:
-            ticks -= 1
+        self.step_state()
 
-            if ticks == 0:
-                self.jumping_cooldown == False
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
+        # Attack beats jump beats block, if more than one key is down.
+        if pressed_keys[K_d]:
+            self.handle_event(ATTACK_INPUT)
+        elif pressed_keys[K_s]:
+            self.handle_event(JUMP_INPUT)
+        elif pressed_keys[K_a]:
+            self.handle_event(BLOCK_INPUT)
+        else:
+            self.handle_event(NO_INPUT)
 
-            elif ticks <= 30:
-                self.rect.y += 3
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
-                #self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-jump-down.png'))
+        state = self.state
 
-            else:
-                self.rect.y -= 3
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
-                #self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-jump-up.png'))
-
-        if self.attacking_cooldown == True:
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-attack-1.png'))
-            self.attacking_timer -= 1
-            if self.attacking_timer <= 0:
-                self.attacking_timer = 0
-                self.attacking_cooldown = False
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
-
-        if self.stun_cooldown == True:
-            self.stun_timer -= 1
-            if self.held_cooldown == True:
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-held-stun.png'))
-            elif self.jumping_cooldown == True:
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-jumping-stun.png'))
-            elif self.knockdown_cooldown == True:
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-knockdown-stun.png'))
-            else:
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-stun.png'))
-            if self.stun_timer < 0:
-                self.stun_timer = 0
-                self.stun_cooldown = False
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
-
-        if self.held_cooldown == True:
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-held.png'))
-            self.held_timer -= 1
-            if self.held_timer <= 0:
-                self.held_timer = 0
-                self.held_cooldown == False
-                self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
-
-        if self.blocking == True:
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-block.png'))
-
-        # Jumping
-            #self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-jump.png'))
-
-        # If hero isn't blocking, attacking or being stunned, then s(he) is able to move
-        if self.blocking == False and self.attacking_cooldown == False and self.stun_cooldown == False and self.held_cooldown == False:
+        # Only some states (not blocking, attacking, stunned, held...) let
+        # the hero walk around.
+        if COMBAT.can_move[state]:
             if pressed_keys[K_LEFT]:
-                self.rect.move_ip(-heroBoonrit.speed, 0)
+                self.rect.move_ip(-self.speed, 0)
+                self.facing = -1
 
             if pressed_keys[K_RIGHT]:
-                self.rect.move_ip(heroBoonrit.speed, 0)
+                self.rect.move_ip(self.speed, 0)
+                self.facing = 1
 
             if pressed_keys[K_UP]:
-                self.rect.move_ip(0, -heroBoonrit.speed)
+                self.rect.move_ip(0, -self.speed)
 
             if pressed_keys[K_DOWN]:
-                self.rect.move_ip(0, heroBoonrit.speed)
-
-            if pressed_keys[K_d]:
-                self.attacking_cooldown = True
-                self.attacking_timer = 20
-
-            if pressed_keys[K_s]:
-                self.jumping_cooldown = True
-                self.jump()
-
-            if pressed_keys[K_a]:
-                self.blocking = True
+                self.rect.move_ip(0, self.speed)
 
         # Stop the player from moving too far off the screen
 
         # Health
-        if self.hp <= 0:
+        hp = self.hp
+        if hp <= 0:
             self.kill()
-        elif self.hp <= 20:
-            #self.image.fill(DEEP_RED)
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-1.png'))
-        elif self.hp <= 60:
-            #self.image.fill(DARK_ORANGE)
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-2.png'))
-        elif self.hp <= 90:
-            #self.image.fill(LIME_GREEN)
-            self.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png'))
+            return
+
+        frame_state, variant = COMBAT.frame[state]
+        if variant is None:
+            variant = min(bisect_left(HP_TIERS, hp), 3)
+        frame = self.frames[self.image_prefix, frame_state, variant]
+        # Frames line up on the side the character is facing away from, so
+        # a wider frame (like a punch) sticks out the front.
+        rect = self.rect
+        if self.facing > 0:
+            self.image = frame
+            rect.size = frame.get_size()
         else:
-            pass
+            self.image = self.variants.get(frame, flip=True)
+            right = rect.right
+            rect.size = frame.get_size()
+            rect.right = right
 
 # Active character
 ac = ["Boonrit", "Hugo", "Joy", "Victoria", "Kelly"]
 
-"""
-**************************************************************************
-    CREATING THE ENEMY
+class VillainStore:
+    """
+    Holds the state that changes every frame - hp, and the combat state and
+    its timer - for a whole crowd of villains, in one array per field
+    instead of one attribute per villain. This is a "structure of arrays."
+
+    Each villain gets a *slot*, an index into the arrays. The `Villain`
+    objects don't keep the values themselves; their `hp`, `state`, etc.
+    attributes read and write their slot (see `StoreField`).
+
+    The point is `tick`: stepping every villain's combat state is a few
+    whole-array operations on the COMBAT tables, instead of a Python loop
+    over the villains. With NumPy available the arrays are NumPy arrays and
+    `tick` is vectorized. Without it, they are `array`s and `tick` is a
+    plain loop - slower, but the same results.
+
+    Positions stay in each sprite's `rect`, because that is where pygame's
+    drawing and collision code (and the SpatialHash) look for them. That
+    also means villains don't follow the states' `path`s.
+    """
 
-    Values: COLOR, SPEED, LEVEL, HP, STAMINA, FEAR
-    Format: Shit_Clown = Enemy(str, int, int, int, int, int)
-    Example:
-    Shit_Clown = Enemy("Shit Clown",30,1,10000,50,20)
+    # A new slot is all zeros: no hp (until the constructor fills it in),
+    # and IDLE.
+    COLUMNS = ('hp', 'state', 'state_timer')
+
+    def __init__(self, *, capacity=64):
+        self.capacity = 0
+        self.size = 0
+        self.owners = []
+        self._free = []
+
+        # Villain subclass -> how many have been made. See Villain.get_id.
+        self.counters = {}
+
+        self.columns = {name: self._new_column(0) for name in self.COLUMNS}
+        self.active = self._new_column(0)
+        self.tier = self._new_column(0)
+        self._grow(capacity)
+
+        if numpy is not None:
+            self._expire = numpy.array(COMBAT.expire, dtype=numpy.int32)
+            self._duration = numpy.array(COMBAT.duration, dtype=numpy.int32)
+
+    @staticmethod
+    def _new_column(length):
+        if numpy is not None:
+            return numpy.zeros(length, dtype=numpy.int32)
+        return array('i', bytes(4 * length))
+
+    def _grow(self, capacity):
+        extra = capacity - self.capacity
+        if numpy is not None:
+            pad = lambda column: numpy.concatenate((column, self._new_column(extra)))
+        else:
+            pad = lambda column: column + self._new_column(extra)
 
-**************************************************************************
-"""
+        self.columns = {name: pad(column) for name, column in self.columns.items()}
+        self.active = pad(self.active)
+        self.tier = pad(self.tier)
+        self.owners.extend([None] * extra)
+        self.capacity = capacity
 
-class Enemy(Character):
-    def __init__(self, name, level, speed, hp, stamina, fear, blocking_cooldown, jumping_cooldown, punching_cooldown, held_cooldown, knockdown_cooldown, stun_cooldown, jumping_timer, punching_timer, held_timer, knockdown_timer, stun_timer, grabbing_cooldown, grabbing_timer, blocking_timer):
-        super().__init__()
-        self.image = pygame.image.load(os.path.join('res','img','chars','shit_clown-3.png'))
-        #self.image = pygame.Surface([30,20])
+        # Let the columns be reached as attributes, too.
+        self.__dict__.update(self.columns)
 
+    def allocate(self, owner):
+        """Give `owner` a slot, cleared to zeros, and return it."""
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self.size == self.capacity:
+                self._grow(self.capacity * 2)
+            slot = self.size
+            self.size += 1
+
+        for column in self.columns.values():
+            column[slot] = 0
+
+        self.owners[slot] = owner
+        self.active[slot] = 1
+        self.tier[slot] = -1
+        return slot
+
+    def release(self, slot):
+        """Give a slot back, for the next `allocate` to reuse."""
+        self.active[slot] = 0
+        self.owners[slot] = None
+        self._free.append(slot)
+
+    def tick(self):
+        """Advance every active villain's combat state by one frame, the way
+        Character.step_state does for one character.
+
+        Returns a list of the villains whose hp tier (see HP_TIERS) changed,
+        along with their new tier.
+        """
+        if numpy is not None:
+            return self._tick_numpy()
+        return self._tick_python()
+
+    def _tick_numpy(self):
+        n = self.size
+        active = self.active[:n].astype(bool)
+        state = self.state[:n]
+        timer = self.state_timer[:n]
+
+        running = active & (timer > 0)
+        timer[running] -= 1
+        done = numpy.flatnonzero(running & (timer == 0))
+        if len(done):
+            new_state = self._expire[state[done]]
+            state[done] = new_state
+            timer[done] = self._duration[new_state]
+
+        tier = numpy.searchsorted(HP_TIERS, self.hp[:n], side='left')
+        changed = numpy.flatnonzero(active & (tier != self.tier[:n]))
+        self.tier[:n] = tier
+
+        owners = self.owners
+        return [(owners[slot], int(tier[slot])) for slot in changed]
+
+    def _tick_python(self):
+        active = self.active
+        state = self.state
+        timer = self.state_timer
+        expire = COMBAT.expire
+        duration = COMBAT.duration
+        hp = self.hp
+        tiers = self.tier
+        owners = self.owners
+        changed = []
+
+        for slot in range(self.size):
+            if not active[slot]:
+                continue
+
+            if timer[slot]:
+                timer[slot] -= 1
+                if timer[slot] == 0:
+                    new_state = expire[state[slot]]
+                    state[slot] = new_state
+                    timer[slot] = duration[new_state]
+
+            tier = bisect_left(HP_TIERS, hp[slot])
+            if tier != tiers[slot]:
+                tiers[slot] = tier
+                changed.append((owners[slot], tier))
+
+        return changed
+
+class StoreField:
+    """An attribute of a Villain that really lives in its VillainStore slot.
+    This is a "descriptor" - Python calls `__get__` and `__set__` whenever
+    the attribute is read or assigned.
+
+    A dead villain has given its slot back, so it has no value to read or
+    assign; that's an AttributeError.
+    """
+
+    def __init__(self, name, kind=int):
         self.name = name
-        self.speed = speed
-        self.level = level
-        self.hp = hp
-        self.stamina = stamina
-        self.fear = fear
-        self.blocking_cooldown = blocking_cooldown
-        self.jumping_cooldown = jumping_cooldown
-        self.jumping_timer = jumping_timer
-        self.punching_cooldown = punching_cooldown
-        self.punching_timer = punching_timer
-        self.held_cooldown = held_cooldown
-        self.held_timer = held_timer
-        self.knockdown_cooldown = knockdown_cooldown
-        self.knockdown_timer = knockdown_timer
-        self.stun_cooldown = stun_cooldown
-        self.stun_timer = stun_timer
-        self.grabbing_cooldown = grabbing_cooldown
-        self.grabbing_timer = grabbing_timer
-        self.blocking_timer = blocking_timer
+        self.kind = kind
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.kind(obj.store.columns[self.name][self.get_slot(obj)])
+
+    def __set__(self, obj, value):
+        obj.store.columns[self.name][self.get_slot(obj)] = value
+
+    def get_slot(self, obj):
+        slot = obj.slot
+        if slot is None:
+            raise AttributeError('{} is dead, so it has no {!r} (its store slot was released)'.format(
+                obj.name, self.name))
+        return slot
+
+class Villain(Character):
+    """
+    A villain's per-frame state (see VillainStore.COLUMNS) is kept in a
+    VillainStore shared with the rest of the crowd; the villain is just a
+    view of its slot. Pass the shared `store` in. If there isn't one, the
+    villain gets a little store all to itself.
+
+    Each subclass lists its stats as FIELDS defaults.
+
+    `vx` and `vy` are the villain's velocity: how far it moves every frame.
+    Its AI (`think`) sets them, but not necessarily every frame - see
+    AIScheduler. `tint` is the color of its hp tier, if any.
+    """
+
+    FIELDS = (
+        ('vx', 0),
+        ('vy', 0),
+        ('tint', None),
+    )
+
+    __slots__ = ('store', 'slot', 'pool')
+
+    team = 1
+
+    # How far (in pixels, left edge to left edge) a villain stops from the
+    # hero's body: close enough to be punched, instead of standing right on
+    # top of the hero, where the punch reaches past it.
+    REACH = 40
+
+    def __init__(self, store=None, **kwargs):
+        if store is None:
+            store = VillainStore(capacity=1)
+        self.store = store
+        self.slot = store.allocate(self)
+        self.pool = None
+
+        super().__init__(**kwargs)
+        if self.name is None:
+            self.name = self.get_name_fmt().format(self.get_id())
+
+        self.refresh_image()
+
+    def respawn(self):
+        """Bring a dead villain back, as good as new: a new slot in its
+        store, every field back to its default, and a new name. (This is
+        how a VillainPool reuses villains.)
+        """
+        self.slot = self.store.allocate(self)
+        for name, value in self.defaults.items():
+            setattr(self, name, value)
+
+        self.name = self.get_name_fmt().format(self.get_id())
+        self.refresh_image()
+        self.rect.topleft = (0, 0)
+
+    def refresh_image(self):
+        """Show the frame for the villain's tint and facing. The frames are
+        shared, so this is just a lookup.
+        """
+        self.image = image = self.variants.get(self.get_frame('idle', 3), self.tint, self.facing < 0)
+        self.rect.size = image.get_size()
+
+    def __repr__(self):
+        cls = type(self).__name__
+        if self.slot is None:
+            # The store fields went with the slot.
+            fields = {name: getattr(self, name) for name in self.field_names
+                      if name not in VillainStore.COLUMNS}
+        else:
+            fields = {name: getattr(self, name) for name in self.field_names}
+        fields['slot'] = self.slot
+        return '{}({})'.format(cls, fields)
+
+    def clone(self, **changes):
+        """Return a new villain just like this one, in a new slot of the same
+        store. It gets a new name, unless one is given in `changes`.
+        """
+        cls = type(self)
+        other = cls.__new__(cls)
+        other.store = self.store
+        other.slot = self.store.allocate(other)
+
+        other.pool = self.pool
+
+        self._clone_into(other, changes)
+        if 'name' not in changes:
+            other.name = other.get_name_fmt().format(other.get_id())
+        other.refresh_image()
+        return other
+
+    def kill(self):
+        super().kill()
+        if self.slot is not None:
+            self.store.release(self.slot)
+            self.slot = None
+            if self.pool is not None:
+                self.pool.release(self)
 
     def grab(self, heroBoonrit):
-        #if self in near_hero_list:
-        #    self.grabbing_cooldown = True
-        #else:
-        #    self.grabbing_cooldown = False
         pass
 
     def punch(self, heroBoonrit):
-        #if self in near_hero_list:
-            #self.punching_cooldown = True
-        #else:
-            #return False
         pass
 
-    def update(self):
-        if self.grabbing_cooldown:
-            self.grabbing_timer -= 1
-            if self.grabbing_timer == 0:
-                self.grabbing_cooldown = False
-                self.grabbing_timer = 60
-
-        #if blocking_cooldown == False and held_cooldown == False and knockdown_cooldown == False and stun_cooldown == False and grabbing_cooldown == False:
-            # Flip the coin.
-            #coin_flip = random.randrange(1,4)
-            #if coin_flip == 1:
-                #timer -= 1
-                #self.rect.move_ip(0, 0)
-                #if timer <= 0
-        #elif coinFlip == 2:
-            #self.rect.move_ip(-1, 0)
-        #else:
-            #self.rect.move_ip(1, 0)
-
-        #if self.attacking_cooldown == True:
-            #self.attacking_timer -= 1
-            #if self.attacking_timer <= 0:
-                #self.attacking_timer = 0
-                #self.attacking_cooldown = False
-
-        if self.hp <= 0:
-            self.kill()
-        elif self.hp <= 20:
-            self.image.fill(DEEP_RED)
-        elif self.hp <= 60:
-            self.image.fill(DARK_ORANGE)
-        elif self.hp <= 90:
-            self.image.fill(LIME_GREEN)
+    def update(self, *args):
+        """Villains are ticked all together, by VillainStore.tick, and react
+        to the results in set_tier. Their AI is run by the AIScheduler,
+        which calls `think`. There's nothing to do one at a time.
+        """
+        pass
+
+    def think(self, game, near):
+        """Decide which way to go: set the velocity, up to `speed` pixels a
+        frame each way. If the villain is `near` the hero, it closes in, to
+        REACH from the hero's body on whichever side it's on (and slows down
+        for the last few pixels, instead of overshooting). Otherwise it flips
+        a (three-sided) coin: stand still, go left, or go right.
+        """
+        speed = self.speed
+        if not COMBAT.can_move[self.state]:
+            self.vx = self.vy = 0
+        elif near:
+            body = game.hero.get_body()
+            side = 1 if self.rect.centerx >= body.centerx else -1
+            dx = body.x + side * self.REACH - self.rect.x
+            dy = body.y - self.rect.y
+            self.vx = max(-speed, min(speed, dx))
+            self.vy = max(-speed, min(speed, dy))
         else:
-            pass
+            self.vx = game.rng.randrange(-1, 2) * speed
+            self.vy = 0
 
-class Villain(Character):
-    def __init__(self):
-        cls = type(self)
-        attrs = cls.ATTRS if hasattr(cls, 'ATTRS') else {}
-        super().__init__(**attrs)
-        if not hasattr(self, 'name'):
-            _id = self.get_id()
-            self.name = self.get_name_fmt().format(_id)
+        # Turn around, if it's walking backwards.
+        if self.vx and (self.vx < 0) != (self.facing < 0):
+            self.facing = -self.facing
+            self.refresh_image()
 
-    def __repr__(self):
-        cls = type(self).__name__
-        return '{}({})'.format(cls, self.__dict__)
+    def set_tier(self, tier):
+        """Show a new hp tier: die at tier 0, otherwise tint the sprite."""
+        if tier == 0:
+            self.kill()
+        elif HP_TIER_COLORS[tier] != self.tint:
+            self.tint = HP_TIER_COLORS[tier]
+            self.refresh_image()
 
     def get_id(self):
         """
-        Keep an integer counter in the class object of each subclass.
-        Look for the `_counter` attribute, create it to 0 if not found.
-        Each time get_id is called, it increments the _counter and
-        returns that value. Thus, each subclass gets a stream of ids
-        like 1, 2, 3, ...
+        Keep an integer counter for each subclass, in the villain's store.
+        Each time get_id is called, it increments the subclass's counter and
+        returns that value. Thus, each subclass gets a stream of ids like
+        1, 2, 3, ... and since every game has its own store, every game
+        starts again from 1.
         """
+        counters = self.store.counters
         cls = type(self)
-        if not hasattr(cls, '_counter'):
-            cls._counter = 0
-
-        cls._counter += 1
-        return cls._counter
+        counters[cls] = counters.get(cls, 0) + 1
+        return counters[cls]
 
     def get_name_fmt(self):
         """
@@ -906,220 +3164,666 @@ class Villain(Character):
             cls.NAME_FMT = cls.__NAME__ + ' {}'
         return cls.NAME_FMT
 
+for _name in VillainStore.COLUMNS:
+    setattr(Villain, _name, StoreField(_name))
+del _name
+
 class JackScrapper(Villain):
     NAME_FMT = 'Jack Scrapper {}'
-    ATTRS = {
-        'image_prefix': 'jack_scrapper',
-        'level': 1,
-        'speed': 4,
-        'hp': 2000,
-        'stamina': 15,
-        'fear': 85,
-    }
+    FIELDS = (
+        ('image_prefix', 'jack_scrapper'),
+        ('level', 1),
+        ('speed', 4),
+        ('hp', 2000),
+        ('stamina', 15),
+        ('fear', 85),
+    )
 
 class ShitClown(Villain):
 
     NAME_FMT = 'Shit Clown {}'
-    ATTRS = {
-        'image_prefix': 'shit_clown',
-        'level': 1,
-        'speed': 4,
-        'hp': 1000,
-        'stamina': 10,
-        'fear': 90,
-    }
+    FIELDS = (
+        ('image_prefix', 'shit_clown'),
+        ('level', 1),
+        ('speed', 4),
+        ('hp', 1000),
+        ('stamina', 10),
+        ('fear', 90),
+    )
+
+class VillainPool:
+    """
+    Keeps dead villains around to be used again, so spawning in the middle
+    of a fight doesn't have to make new objects (and, later on, the garbage
+    collector doesn't have to clean them up).
+
+    `acquire` hands out a villain of the given class: a recycled one if
+    there is one, or else a brand new one. When a pooled villain is killed,
+    it comes back to the pool by itself. `reserve` makes villains ahead of
+    time, at level load, so that even the first wave needs nothing new.
+    """
 
-class GrapevineGame(PygameModel):
-    def __init__(self, view=None):
-        super().__init__()
-        self.view = view
+    def __init__(self, store):
+        self.store = store
+        self._free = {}
+
+    def reserve(self, cls, count):
+        """Make sure at least `count` villains of class `cls` are waiting."""
+        free = self._free.setdefault(cls, [])
+        while len(free) < count:
+            # No name yet; it gets one when it is respawned.
+            villain = cls(store=self.store, name='')
+            villain.pool = self
+            villain.kill()
+
+    def acquire(self, cls):
+        """Return a live villain of class `cls`, not in any sprite group."""
+        free = self._free.get(cls)
+        if free:
+            villain = free.pop()
+            villain.respawn()
+        else:
+            villain = cls(store=self.store)
+            villain.pool = self
+        return villain
 
-def parse_cli():
-    """Parse command-line switches, provide defaults, and return them in a nice dictionary.
+    def release(self, villain):
+        """Take back a dead villain. (Villain.kill calls this.)"""
+        self._free.setdefault(type(villain), []).append(villain)
+
+    def available(self, cls):
+        return len(self._free.get(cls, ()))
+
+# kind: the Villain class. region: a Rect to spawn them in. interval: frames
+# between spawns (0 spawns the whole wave at once). at: the frame the wave
+# starts.
+Wave = namedtuple('Wave', 'kind count region interval at')
+
+class WaveSpawner:
+    """
+    Spawns villains out of a VillainPool according to a list of Waves. Each
+    wave starts on frame `at`, and spawns one villain of class `kind` every
+    `interval` frames, until it has spawned `count` of them. An interval of
+    0 spawns all `count` on frame `at`. The villains appear at random places
+    inside `region`, picked with the game's rng.
     """
 
-    args = {}
-    args['resolution'] = (SCREEN_WIDTH, SCREEN_HEIGHT)
-    args['framerate'] = 30
-    return args
+    def __init__(self, game, pool, waves=()):
+        for wave in waves:
+            if wave.interval < 0:
+                raise ValueError('Wave interval must be 0 or more, not {}'.format(wave.interval))
+        self.game = game
+        self.pool = pool
+        self.waves = sorted(waves, key=lambda wave: wave.at)
+        self.frame = 0
+        self._spawned = [0] * len(self.waves)
+
+    def reserve(self):
+        """Fill the pool with enough villains for every wave, ahead of time."""
+        needed = {}
+        for wave in self.waves:
+            needed[wave.kind] = needed.get(wave.kind, 0) + wave.count
+        for cls, count in needed.items():
+            self.pool.reserve(cls, count)
+
+    def finished(self):
+        return all(spawned == wave.count for wave, spawned in zip(self.waves, self._spawned))
+
+    def tick(self):
+        """Spawn whatever is due this frame."""
+        frame = self.frame
+        self.frame += 1
+
+        for n, wave in enumerate(self.waves):
+            if wave.at > frame:
+                break
+
+            spawned = self._spawned[n]
+            if spawned == wave.count:
+                continue
+            if wave.interval == 0:
+                due = wave.count - spawned
+            else:
+                due = int((frame - wave.at) % wave.interval == 0)
 
-def main():
-    args = parse_cli()
+            self._spawned[n] = spawned + due
+            for _ in range(due):
+                self.spawn(wave.kind, wave.region)
 
-    rmgr = GrapevineResourceManager(resource_dir='res')
-    view = GrapevineView(resolution=args['resolution'],
-            resource_manager=rmgr)
-    model = GrapevineGame(view=view)
-    controller = PygameController(model=model, view=view, framerate_hz=args['framerate'])
-    controller.run()
+    def spawn(self, cls, region):
+        game = self.game
+        villain = self.pool.acquire(cls)
+        villain.rect.x = game.rng.randrange(region.left, region.right)
+        villain.rect.y = game.rng.randrange(region.top, region.bottom)
+        game.add_character(villain, game.enemy_list)
+        return villain
 
-    sys.exit(0)
+class AIScheduler:
+    """
+    Decides which villains get to `think` (run their AI) on each frame, so
+    the AI takes about the same time each frame no matter how big the crowd
+    gets.
+
+      - Villains near the hero (in the game's near_hero_list) think every
+        frame. They're the ones the player is watching.
+
+      - Other villains on the screen take turns, round-robin. Each gets a
+        turn about every `interval` frames, as long as that fits in the
+        `budget`: at most that many thinks per frame, counting the near ones.
+        With a big crowd, they just get turns less often. (The near ones
+        think even if they alone go over the budget.)
+
+      - Villains off the screen don't think at all. They carry on the way
+        they were going.
+
+    Whether they thought this frame or not, every villain moves by its
+    velocity, and is kept inside `bounds`.
 
+    The budget is counted in thinks, not seconds. A budget in seconds would
+    make the game play out differently on a faster machine, and recorded
+    games (see InputLog) wouldn't replay the same.
     """
-    **************************************************************************
-        SPAWNING THE HERO
-        Outdate Values: name, speed, level, hp, stamina, fear, blocking, jumping_cooldown, attacking_cooldown, held_cooldown, knockdown_cooldown, jumping_timer, attacking_timer, held_timer, knockdown_timer
-    **************************************************************************
+
+    def __init__(self, *, budget=32, interval=8, bounds=None):
+        if interval < 1:
+            raise ValueError('AIScheduler interval must be at least 1 frame, not {}'.format(interval))
+        self.budget = budget
+        self.interval = interval
+        self.bounds = bounds
+        self.villains = []
+        self.thinks = 0
+        self._cursor = 0
+        self._members = set()
+
+    def add(self, villain):
+        # A villain can die and come back (see VillainPool) before tick
+        # gets around to dropping it. Then it's still here.
+        if villain not in self._members:
+            self._members.add(villain)
+            self.villains.append(villain)
+
+    def tick(self, game, near, view_rect):
+        """Run one frame: let the villains in `near` think, then give turns to
+        the others inside `view_rect`, then move everyone.
+        """
+        thinks = 0
+        for villain in near:
+            villain.think(game, True)
+            thinks += 1
+
+        # Take turns in the order the villains were added, carrying on from
+        # where the last frame left off. (A set, because asking a sprite
+        # Group "is this in you?" is slow.)
+        villains = self.villains
+        count = len(villains)
+        quota = min(self.budget - thinks, -(-count // self.interval))
+        if quota > 0 and count:
+            near = set(near.sprites())
+            onscreen = view_rect.colliderect
+            i = self._cursor % count
+            for _ in range(count):
+                villain = villains[i]
+                i = (i + 1) % count
+                if villain.slot is not None and villain not in near and onscreen(villain.rect):
+                    villain.think(game, False)
+                    thinks += 1
+                    quota -= 1
+                    if quota == 0:
+                        break
+            self._cursor = i
+
+        self.thinks = thinks
+
+        # Everyone moves. Dead villains (whose slot is gone) are dropped.
+        bounds = self.bounds
+        dead = False
+        for villain in villains:
+            if villain.slot is None:
+                dead = True
+            elif villain.vx or villain.vy:
+                rect = villain.rect
+                rect.move_ip(villain.vx, villain.vy)
+                if bounds is not None:
+                    rect.clamp_ip(bounds)
+
+        if dead:
+            self.villains = [villain for villain in villains if villain.slot is not None]
+            self._members = set(self.villains)
+
+Hit = namedtuple('Hit', 'attacker target damage blocked')
+
+class CombatEngine:
+    """
+    Works out who hit whom, once a frame, from the characters' HITBOXES and
+    HURTBOXES.
+
+    Each frame, `tick` gathers up every active hitbox, and the hurtboxes of
+    everyone those hitboxes could reach (the spatial index finds them), and
+    tests every hitbox against every hurtbox in one go. With numpy, that's
+    one array operation for the lot; without it, it's a Rect.collidelistall
+    per hitbox.
+
+    Boxes are only the broadphase. A box is a rough outline, and a fist
+    can graze the corner of a hurtbox without touching anyone. So each pair
+    of boxes that overlap is checked again, pixel by pixel, with the
+    collision masks (`get_mask`, see PygameResourceManager.get_mask): it's
+    only a hit if the attacker's frame and the target's frame have opaque
+    pixels in the same place, inside both boxes.
+
+    An attack hits each target at most once, however many of its boxes (or
+    active frames) overlap the target. Characters don't hit their own team.
+
+    The engine only reports hits, as a list of Hit tuples. What a hit does
+    (damage, sounds, ...) is up to the game. `damage` is already the chip
+    damage if the target was blocking.
+    """
+
+    def __init__(self, spatial_index, get_bounding_boxes, get_mask):
+        self.spatial_index = spatial_index
+        self.get_bounding_boxes = get_bounding_boxes
+        self.get_mask = get_mask
+        # attacker -> the targets its current attack has hit
+        self._already_hit = {}
+
+    def tick(self, attackers):
+        """Return the hits landed this frame by any of `attackers`."""
+        already_hit = self._already_hit
+        active = {}
+        hitboxes = []
+
+        for attacker in attackers:
+            boxes = attacker.get_hitboxes()
+            if not boxes:
+                continue
+
+            # Attacks that are over (or between active frames) are forgotten.
+            active[attacker] = already_hit.get(attacker) or set()
+            rect = attacker.rect
+            for x, y, w, h, damage, chip in boxes:
+                if attacker.facing < 0:
+                    x = rect.width - x - w
+                hitboxes.append((rect.x + x, rect.y + y, w, h, attacker, damage, chip))
+
+        self._already_hit = active
+        if not hitboxes:
+            return []
+
+        # Only someone whose rect touches a hitbox can be hit by it. (A dict,
+        # to keep them in a repeatable order.)
+        query_rect = self.spatial_index.query_rect
+        targets = {}
+        for x, y, w, h, *_ in hitboxes:
+            for target in query_rect(pygame.Rect(x, y, w, h)):
+                targets[target] = None
+
+        hurtboxes = []
+        owners = []
+        for target in targets:
+            for box in self.get_hurtboxes(target):
+                hurtboxes.append(box)
+                owners.append(target)
+
+        if not hurtboxes:
+            return []
+
+        hits = []
+        for i, j in self.overlaps(hitboxes, hurtboxes):
+            attacker = hitboxes[i][4]
+            target = owners[j]
+            if target.team == attacker.team or target in active[attacker]:
+                continue
+
+            area = pygame.Rect(hitboxes[i][:4]).clip(hurtboxes[j])
+            if not self.pixels_touch(attacker, target, area):
+                continue
+
+            active[attacker].add(target)
+            blocked = target.state == BLOCK
+            damage = hitboxes[i][6] if blocked else hitboxes[i][5]
+            hits.append(Hit(attacker, target, damage, blocked))
+
+        return hits
+
+    def get_hurtboxes(self, character):
+        """Return `character`'s hurtboxes, as (x, y, w, h) on the screen."""
+        rect = character.rect
+        boxes = character.HURTBOXES
+        if boxes is None:
+            # The frame's own boxes are already the right way around.
+            boxes = self.get_bounding_boxes(character.image)
+        elif character.facing < 0:
+            boxes = [(rect.width - x - w, y, w, h) for x, y, w, h in boxes]
+
+        left, top = rect.topleft
+        return [(left + x, top + y, w, h) for x, y, w, h in boxes]
+
+    def pixels_touch(self, attacker, target, area):
+        """The narrowphase: do the opaque pixels of `attacker`'s and
+        `target`'s current frames overlap anywhere inside `area`, a rect on
+        the screen?
+        """
+        a_rect = attacker.rect
+        t_rect = target.rect
+        both = self.get_mask(attacker.image).overlap_mask(
+                self.get_mask(target.image), (t_rect.x - a_rect.x, t_rect.y - a_rect.y))
+        window = pygame.Mask(area.size, fill=True)
+        return both.overlap(window, (area.x - a_rect.x, area.y - a_rect.y)) is not None
+
+    @staticmethod
+    def overlaps(hitboxes, hurtboxes):
+        """Return (i, j) for every hitbox i that overlaps hurtbox j, ordered
+        by i and then j. Boxes that only share an edge don't overlap, and
+        neither do empty boxes - the same as Rect.colliderect.
+        """
+        if numpy is not None:
+            hit = numpy.array([box[:4] for box in hitboxes])
+            hurt = numpy.array(hurtboxes)
+
+            # One row per hitbox, one column per hurtbox.
+            left, top = hit[:, 0, None], hit[:, 1, None]
+            right, bottom = left + hit[:, 2, None], top + hit[:, 3, None]
+            overlap = ((left < hurt[:, 0] + hurt[:, 2]) & (hurt[:, 0] < right) &
+                       (top < hurt[:, 1] + hurt[:, 3]) & (hurt[:, 1] < bottom) &
+                       (hit[:, 2, None] > 0) & (hit[:, 3, None] > 0) &
+                       (hurt[:, 2] > 0) & (hurt[:, 3] > 0))
+            return zip(*(indices.tolist() for indices in numpy.nonzero(overlap)))
+
+        hurt_rects = [pygame.Rect(box) for box in hurtboxes]
+        return [(i, j) for i, box in enumerate(hitboxes)
+                for j in pygame.Rect(box[:4]).collidelistall(hurt_rects)]
+
+class KeySet(frozenset):
+    """A set of pressed keys that can stand in for the result of
+    `pygame.key.get_pressed()`: `keys[K_LEFT]` is True if K_LEFT is in
+    the set. Used to feed scripted input to the model.
     """
-# Boonrit, Male, Thailand
-    heroBoonrit = Hero("Boonrit",1,3,10000,50,20,False,False,False,False,False,False,False,0,0,0,0,0,0)
-#Name
-#Level
-#Speed
-#HP
-#Stamina
-#Fear
-#Blocking
-#Jumping Cooldown
-#Attacking Cooldown
-#Held Cooldown
-#Knockdown Cooldown
-#Stun Cooldown
-#Grabbed Cooldown
-#Jumping Countdown
-#Attacking Countdown
-#Held Countdown
-#Knockdown Countdown
-#Stun Countdown
-#Grabbed Countdown
-    heroBoonrit.image = pygame.image.load(os.path.join('res','img','chars','boonrit-3.png')).convert()
-    heroBoonrit.rect.x = 100
-    heroBoonrit.rect.y = 300
-    heroes_list.add(heroBoonrit)
-    all_sprites_list.add(heroBoonrit)
+    __slots__ = ()
+    __getitem__ = frozenset.__contains__
+
+NO_KEYS = KeySet()
+
+# The keys the game looks at. InputLog records each one as a bit, in this
+# order.
+INPUT_KEYS = (K_LEFT, K_RIGHT, K_UP, K_DOWN, K_a, K_s, K_d)
 
+class InputLog:
     """
-    **************************************************************************
-        SPAWNING ENEMIES
-        Values: name, level, speed, hp, stamina, fear, blocking_cooldown, jumping_cooldown, attacking_cooldown, held_cooldown, knockdown_cooldown, stun_cooldown, jumping_timer, attacking_timer, held_timer, knockdown_timer, stun_timer, grabbing_cooldown, grabbing_timer, blocking_timer
-    **************************************************************************
+    A recording of a game's input: its random seed, and which of the keys
+    in `keys` were held down on each frame. That's all it takes to play the
+    game again exactly the same way (see `replay_input`).
+
+    Each frame's keys are packed into a bitmask - bit 0 for keys[0], and so
+    on. Most of the time, the keys don't change from one frame to the next,
+    so the masks are stored as "runs": [count, mask] means `count` frames in
+    a row with the same keys. This is called run-length encoding. A minute
+    of standing still is one run.
+
+    The file format is the header (magic, seed, number of keys, the key
+    codes, number of runs) and then the runs: a 2-byte count, and a mask
+    just wide enough for the keys - 1 byte for up to 8 keys, 2 for up to
+    16, and so on, up to 64. The number of keys is in the header, so
+    `load` knows how wide the masks are.
     """
 
-# Spawn 3 Shit Clowns
-#def __init__(self, name, level, speed, hp, stamina, fear, blocking_cooldown, jumping_cooldown, attacking_cooldown, held_cooldown, knockdown_cooldown, stun_cooldown, jumping_timer, attacking_timer, held_timer, knockdown_timer, stun_timer, grabbing_cooldown, grabbing_timer, blocking_timer):
-    for i in range(2):
-        enemyShit_Clown = Enemy("Shit Clown"+str(i), 1, 4, 1000, 10, 90, False, False, False, False, False, False, 0, 0, 0, 0, 0, False, 60, 0)
-        enemyShit_Clown.image = pygame.image.load(os.path.join('res','img','chars','shit_clown-3.png')).convert()
-        enemyShit_Clown.rect.x = random.randrange(300, 400)
-        enemyShit_Clown.rect.y = random.randrange(200, 400)
-        enemy_list.add(enemyShit_Clown)
-        all_sprites_list.add(enemyShit_Clown)
-
-# Spawn 2 Jack Scrappers
-    for i in range(0):
-        enemyJack_Scrapper = Enemy("Jack Scrapper "+str(i), 1, 4, 2000, 15, 85, False, False, False, False, False, False, 0, 0, 0, 0, 0, 0, 0)
-        enemyJack_Scrapper.image = pygame.image.load(os.path.join('res','img','chars','jack_scrapper-3.png')).convert()
-        enemyJack_Scrapper.rect.x = 100 #random.randrange(600, 700)
-        enemyJack_Scrapper.rect.y = 100 #random.randrange(200, 400)
-        enemy_list.add(enemyJack_Scrapper)
-        all_sprites_list.add(enemyJack_Scrapper)
+    MAGIC = b'GVINPUT1'
+    HEADER = struct.Struct('<qB')
+    MAX_RUN = 0xFFFF
+
+    # Struct codes for the masks, by how many keys they hold.
+    MASKS = ((8, 'B'), (16, 'H'), (32, 'I'), (64, 'Q'))
+
+    def __init__(self, seed, keys=INPUT_KEYS):
+        self.seed = seed
+        self.keys = tuple(keys)
+        self.run = self.get_run_struct(len(self.keys))
+        self.runs = []
+        self.ticks = 0
 
+    @classmethod
+    def get_run_struct(cls, nkeys):
+        """Return the struct for one [count, mask] run, with room for
+        `nkeys` keys in the mask.
+        """
+        for bits, code in cls.MASKS:
+            if nkeys <= bits:
+                return struct.Struct('<H' + code)
+        raise ValueError('An input log can record at most {} keys, not {}'.format(bits, nkeys))
+
+    def append(self, mask):
+        """Add one frame's keys, as a bitmask."""
+        runs = self.runs
+        if runs and runs[-1][1] == mask and runs[-1][0] < self.MAX_RUN:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, mask])
+        self.ticks += 1
+
+    def keysets(self):
+        """Return a list with the KeySet for each frame. Frames with the same
+        keys share the same KeySet.
+        """
+        keysets = {}
+        frames = []
+        for count, mask in self.runs:
+            if mask not in keysets:
+                keysets[mask] = KeySet(key for bit, key in enumerate(self.keys)
+                                       if mask & (1 << bit))
+            frames.extend([keysets[mask]] * count)
+        return frames
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(self.HEADER.pack(self.seed, len(self.keys)))
+            f.write(struct.pack('<{}i'.format(len(self.keys)), *self.keys))
+            f.write(struct.pack('<I', len(self.runs)))
+            f.write(b''.join(self.run.pack(count, mask) for count, mask in self.runs))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic = cls.MAGIC
+        if data[:len(magic)] != magic:
+            raise ValueError("'{}' is not an input log".format(path))
+
+        offset = len(magic)
+        seed, nkeys = cls.HEADER.unpack_from(data, offset)
+        offset += cls.HEADER.size
+        keys = struct.unpack_from('<{}i'.format(nkeys), data, offset)
+        offset += 4 * nkeys
+        nruns, = struct.unpack_from('<I', data, offset)
+        offset += 4
+
+        log = cls(seed, keys)
+        run = log.run
+        log.runs = [list(counts) for counts in run.iter_unpack(data[offset:offset + nruns * run.size])]
+        log.ticks = sum(count for count, _ in log.runs)
+        return log
+
+class InputRecorder:
+    """Records a game's input into an InputLog, as it's played. It takes the
+    place of the game's `get_pressed`: every time the game reads the keys,
+    the keys it gets are also written down.
     """
-    **************************************************************************
-        MAIN GAME LOOP
-    **************************************************************************
+
+    def __init__(self, model, keys=INPUT_KEYS):
+        self.log = InputLog(model.seed, keys)
+        self.get_pressed = model.get_pressed
+        self.bits = tuple((key, 1 << bit) for bit, key in enumerate(keys))
+        model.get_pressed = self
+
+    def __call__(self):
+        pressed = self.get_pressed()
+        mask = 0
+        for key, bit in self.bits:
+            if pressed[key]:
+                mask |= bit
+
+        self.log.append(mask)
+        return pressed
+
+class GrapevineGame(PygameModel):
     """
-#screen.blit(heroBoonrit.surf, (30,20))
-    contact = pygame.sprite.spritecollide(heroBoonrit, enemy_list, False)
+    The game world. Each call to `update_frame` is one frame of game time.
 
+    `get_pressed` is called once per frame to read the keyboard. It is
+    `pygame.key.get_pressed` by default, but anything that returns something
+    indexable by key constant (like a `KeySet`) will do.
 
-    running = True
-    while running:
+    All the randomness in the game comes from `self.rng`, which is seeded
+    with `seed`. Two games with the same seed and the same input play out
+    the same way. If no seed is given, one is picked at random - but it is
+    still saved in `self.seed`, so the game can be replayed (see InputLog).
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+    Villains come from `self.villain_pool`. Besides the ones that are there
+    from the start (see `spawn_enemies`), more arrive in `waves`, a list of
+    Wave tuples (see WaveSpawner).
 
-        screen.fill(BLACK)
-        pygame.draw.rect(screen, DIM_GRAY, (20, 20, 250, 30))
-        pygame.draw.rect(screen, DIM_GRAY, (20, 55, 250, 5))
-        pygame.draw.rect(screen, DIM_GRAY, (275, 10, 70, 70))
+    The level is `stage` (a Stage; default STAGE_1). The `camera` follows
+    the hero along it, and `view_rect` is the camera's rect: the part of
+    the world that's on the screen.
+    """
 
-        #pygame.font.Font.render("Boonrit")
-        pressed_keys = pygame.key.get_pressed()
-        heroBoonrit.update(pressed_keys)
-        enemy_list.update()
-        near_hero_list.update()
+    def __init__(self, view=None, seed=None, waves=(), stage=None):
+        super().__init__()
+        self.view = view
+        if seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.get_pressed = pygame.key.get_pressed
+
+        # Decode every character frame up front, packed into an atlas (the
+        # first time; after that, every game shares the same frames). After
+        # this, the characters never touch the disk.
+        rmgr = view.resource_manager
+        Character.frames = rmgr.load_frame_table()
+        Character.variants = VariantCache()
+
+        self.all_sprites_list = pygame.sprite.Group()
+        self.heroes_list = pygame.sprite.Group()
+        self.enemy_list = pygame.sprite.Group()
+        self.near_hero_list = pygame.sprite.Group()
+        self.spatial_index = SpatialHash(cell_size=64)
+        self.villain_store = VillainStore()
+        self.villain_pool = VillainPool(self.villain_store)
+        self.wave_spawner = WaveSpawner(self, self.villain_pool, waves)
+        self.wave_spawner.reserve()
+        self.combat = CombatEngine(self.spatial_index, rmgr.get_bounding_boxes, rmgr.get_mask)
+
+        if stage is None:
+            stage = STAGE_1
+        self.stage = stage
+        self.camera = Camera((SCREEN_WIDTH, SCREEN_HEIGHT), stage.rect)
+        self.view_rect = self.camera.rect
+
+        # Villains wander around the playable part of the stage, and think
+        # when the scheduler says so.
+        self.ai_scheduler = AIScheduler(bounds=pygame.Rect(0, 0,
+                stage.rect.width - (SCREEN_WIDTH - PLAYABLE_SCREEN_WIDTH), PLAYABLE_SCREEN_HEIGHT))
+
+        self.spawn_hero()
+        self.spawn_enemies()
+
+        view.add_sprites(self.all_sprites_list)
+        view.set_stage(stage)
+        view.set_camera(self.camera)
+
+    def spawn_hero(self):
+        """
+        **************************************************************************
+            SPAWNING THE HERO
+            Values: name, level, speed, hp, stamina, fear
+        **************************************************************************
+        """
+        # Boonrit, Male, Thailand
+        heroBoonrit = Hero("Boonrit",1,3,10000,50,20)
+        heroBoonrit.image = heroBoonrit.get_frame('idle', 3)
+        heroBoonrit.rect = heroBoonrit.image.get_rect(x=100, y=300)
+        self.add_character(heroBoonrit, self.heroes_list)
+        self.hero = heroBoonrit
+
+    def spawn_enemies(self):
+        """
+        **************************************************************************
+            SPAWNING ENEMIES
+            Stats come from each Villain subclass's FIELDS. Everyone starts out
+            IDLE.
+        **************************************************************************
+        """
+        # Spawn 2 Shit Clowns
+        for i in range(2):
+            enemyShit_Clown = self.villain_pool.acquire(ShitClown)
+            enemyShit_Clown.rect.x = self.rng.randrange(300, 400)
+            enemyShit_Clown.rect.y = self.rng.randrange(200, 400)
+            self.add_character(enemyShit_Clown, self.enemy_list)
+
+        # Spawn 0 Jack Scrappers
+        for i in range(0):
+            enemyJack_Scrapper = self.villain_pool.acquire(JackScrapper)
+            enemyJack_Scrapper.rect.x = 100 #self.rng.randrange(600, 700)
+            enemyJack_Scrapper.rect.y = 100 #self.rng.randrange(200, 400)
+            self.add_character(enemyJack_Scrapper, self.enemy_list)
+
+    def add_character(self, character, *groups):
+        """Put a newly spawned character into the game: the given sprite
+        groups, all_sprites_list, and the spatial index.
+        """
+        character.add(self.all_sprites_list, *groups)
+        self.spatial_index.insert(character)
+        if isinstance(character, Villain):
+            self.ai_scheduler.add(character)
 
-        for villan in enemy_list:
-            if (abs(villan.rect.x - heroBoonrit.rect.x)) < 60 and (abs(villan.rect.y - heroBoonrit.rect.y)) < 30:
+    def update_frame(self):
+        heroBoonrit = self.hero
+        enemy_list = self.enemy_list
+        near_hero_list = self.near_hero_list
+        spatial_index = self.spatial_index
+
+        self.wave_spawner.tick()
+
+        # Remember where everyone was, so the view can interpolate.
+        for sprite in self.all_sprites_list:
+            sprite.prev_pos = sprite.rect.topleft
+
+        pressed_keys = self.get_pressed()
+        heroBoonrit.update(pressed_keys)
+        heroBoonrit.rect.clamp_ip(self.stage.rect)
+        self.camera.follow(heroBoonrit.rect)
+
+        # Tick every villain's timers at once, then let the ones whose hp
+        # tier changed react to it.
+        for villan, tier in self.villain_store.tick():
+            villan.set_tier(tier)
+
+        # The villains decide what to do (some of them, anyway) and move.
+        # The ones near the hero are from last frame's near_hero_list.
+        self.ai_scheduler.tick(self, near_hero_list, self.view_rect)
+
+        # Keep the spatial index up to date with wherever everyone moved.
+        # (Anyone killed this frame has already left it.)
+        spatial_update = spatial_index.update
+        for sprite in self.all_sprites_list:
+            spatial_update(sprite)
+
+        near_hero_list.empty()
+        for villan in spatial_index.query_range(heroBoonrit.rect.x, heroBoonrit.rect.y, 60, 30):
+            if villan in enemy_list:
                 near_hero_list.add(villan)
-            if (abs(villan.rect.x - heroBoonrit.rect.x)) >= 60 or (abs(villan.rect.y - heroBoonrit.rect.y)) >= 30:
-                near_hero_list.remove(villan)
-            if villan.grab(heroBoonrit):
-                print("Grabbing")
-
-        if heroBoonrit.attacking_cooldown:
-            for villan in enemy_list:
-                for villan in contact:
-                    if villan.blocking_cooldown != True:
-                        villan.hp -= 100
-                    else:
-                        villan.hp -= 10
-
-        #for villan in enemy_list:
-            #if (abs(villan.rect.x) - abs(heroBoonrit.rect.x) <= 10) and (abs(villan.rect.y) - abs(heroBoonrit.rect.y) <= 10):
-                #near_hero_list.add(villan)
-            #if (abs(villan.rect.x) - abs(heroBoonrit.rect.x) > 100) and (abs(villan.rect.y) - abs(heroBoonrit.rect.y) > 10):
-                #near_hero_list.remove(villan)
-            #if math.sqrt(((villan.rect.x - heroBoonrit.rect.x) **2) + ((villan.rect.x - heroBoonrit.rect.x) **2)) <= 10 and math.sqrt(((villan.rect.y - heroBoonrit.rect.y) **2) + ((villan.rect.y - heroBoonrit.rect.y) **2)) <= 100:
-                #near_hero_list.add(villan)
-            #if math.sqrt(((villan.rect.x - heroBoonrit.rect.x) **2) + ((villan.rect.x - heroBoonrit.rect.x) **2)) > 10 and math.sqrt(((villan.rect.y - heroBoonrit.rect.y) **2) + ((villan.rect.y - heroBoonrit.rect.y) **2)) > 100:
-                #near_hero_list.add(villan)
-            #contact = pygame.sprite.spritecollide(heroBoonrit, enemy_list, False)
-            #if heroBoonrit.attacking_cooldown:
-                #for villan in contact:
-                    #if villan.blocking != True:
-                        #villan.hp -= 100
-                    #else:
-                        #villan.hp -= 10
-
-
-        #screen.blit(bg, (0, 0))
-        all_sprites_list.draw(screen)
-        pygame.display.flip()
+                if villan.grab(heroBoonrit):
+                    print("Grabbing")
 
-#*************************************************************************
-#   DIAGNOSTICS
-#*************************************************************************
+        # Land this frame's hits. Anyone who could be attacking is a hero,
+        # or a villain close enough to reach one.
+        hits = self.combat.tick((*self.heroes_list, *near_hero_list))
+        for hit in hits:
+            hit.target.hp -= hit.damage
 
-        #print(enemy_list)
-        #print("Enemy Grabbing: ", enemyShit_Clown.grabbing_cooldown, "| Enemy Countdown", enemyShit_Clown.grabbing_timer )
-        #for villan in enemy_list:
-        #    print(abs(heroBoonrit.rect.y - villan.rect.y))
-        #print(pressed_keys[K_s], heroBoonrit.jumping_cooldown)
-        #print("|Boonrit HP| ", heroBoonrit.hp)
-        #print(abs(heroBoonrit.rect.y - enemyShit_Clown.rect.y))
-        #print("||Shit Clown|| Grabbing = ", enemyShit_Clown.grabbing_cooldown, " Countdown = ", enemyShit_Clown.grabbing_timer, "||Boonrit|| Grabbed = ", heroBoonrit.held_cooldown, " Countdown = ", heroBoonrit.held_timer)
-        #print("|Clown HP| ", enemyShit_Clown.hp, "|Boonrit HP| ", heroBoonrit.hp, enemyShit_Clown.grabbing_cooldown, heroBoonrit.held_cooldown)
-        #print(" |Score| ", Score)
-        #print(" |J| ", heroBoonrit.jumping_cooldown)
-        #print(" |A| ", heroBoonrit.attacking_cooldown)
-        #print(heroBoonrit.attacking_timer)
-        #print(" |H| " , heroBoonrit.held_cooldown)
-        #print(" |K| ", heroBoonrit.knockdown_cooldown)
-        #print(" |S| ", heroBoonrit.stun_cooldown)
-        #print("|Clown HP| ", enemyShit_Clown.hp)
-        #print(enemyShit_Clown.image.get_rect())
-        #print(enemyShit_Clown.rect)
-        #print(heroBoonrit.rect)
-        #print(contact)
-        #print(enemy_list)
-        #print(all_sprites_list)
-        #print(heroes_list)
-        #for i in enemy_list:
-        #    print(i.name, "Grabbing: ", i.grabbing_cooldown)
-        #for i in near_hero_list:
-        #    print(i.name, "Grabbing: ", i.grabbing_cooldown)
-        #for i in enemy_list:
-             #print("|Delta X| ", (abs(villan.rect.x) - abs(heroBoonrit.rect.x) <= 100), "|Delta Y| ", (abs(villan.rect.y) - abs(heroBoonrit.rect.y) <= 10))
-        #for i in near_hero_list:
-            #print(i.name)
-        #print(heroBoonrit.image.get_rect())
-
-    pygame.QUIT
+        if hits:
+            self.view.play_sound('oof', priority=1)
 
-    """
         #See if the player has collided with anything
         #enemy_hit_list = pygame.sprite.spritecollide(player, enemy_list, True)
         #for enemy in enemy_hit_list:
@@ -1127,11 +3831,168 @@ def main():
         #    print(player.hp)
         #    #Stun the player
         #    player_stun = 3
-        #    pygame.mixer.Sound('res\audio\oof.wav').play()
+        #    self.view.play_sound('oof')
         #    while player_stun > 0:
         #        player_stun -= 1
         #        pygame.time.delay(300)
+
+    def get_state(self):
+        """Return a snapshot of the game world as plain Python data."""
+        hero = self.hero
+        return {
+            'seed': self.seed,
+            'hero': {'name': hero.name, 'hp': hero.hp, 'pos': hero.rect.topleft,
+                     'state': COMBAT.names[hero.state], 'alive': hero.alive()},
+            'enemies': [{'name': villan.name, 'hp': villan.hp, 'pos': villan.rect.topleft}
+                        for villan in self.enemy_list],
+        }
+
+TickStats = namedtuple('TickStats', 'tick seconds hero_hp enemies near_hero')
+
+def run_headless(ticks, seed=None, input_script=None, *, resource_dir='res',
+        capture=None, capture_format='png'):
+    """Run the game with no window and no frame rate limit, for `ticks` frames.
+    This is for soak tests and balance tuning: thousands of frames per second.
+
+    `input_script` says which keys are held down on each frame. It can be
+    None (no keys, ever), a sequence with one entry per frame (frames past
+    the end get no keys), or a function that takes the frame number. Each
+    entry is an iterable of key constants, like `(K_RIGHT, K_d)`.
+
+    To record the game as it goes, give a `capture` path (see FrameCapture
+    for it and `capture_format`). Every frame is drawn, offscreen, and
+    written out; that takes longer than just running the model, but it's
+    still faster than playing. Drawing isn't counted in the stats.
+
+    Returns `(state, stats)`: the final `GrapevineGame.get_state()`, and a
+    list with one `TickStats` per frame.
     """
+    rmgr = GrapevineResourceManager(resource_dir=resource_dir)
+    view = GrapevineView(resolution=(SCREEN_WIDTH, SCREEN_HEIGHT),
+            resource_manager=rmgr, headless=True)
+    model = GrapevineGame(view=view, seed=seed)
+    if capture is not None:
+        view.start_capture(capture, format=capture_format)
+
+    if input_script is None:
+        script = lambda tick: NO_KEYS
+    elif callable(input_script):
+        script = lambda tick: KeySet(input_script(tick))
+    else:
+        keysets = [keys if isinstance(keys, KeySet) else KeySet(keys) for keys in input_script]
+        script = lambda tick: keysets[tick] if tick < len(keysets) else NO_KEYS
+
+    tick = 0
+    model.get_pressed = lambda: script(tick)
+
+    # Cache these function lookups.
+    model_update_frame = model.update_frame
+    perf_counter = time.perf_counter
+    hero = model.hero
+    enemy_list = model.enemy_list
+    near_hero_list = model.near_hero_list
+
+    view_update = view.update if capture is not None else None
+
+    stats = []
+    for tick in range(ticks):
+        start = perf_counter()
+        model_update_frame()
+        elapsed = perf_counter() - start
+        stats.append(TickStats(tick, elapsed, hero.hp, len(enemy_list), len(near_hero_list)))
+        if view_update is not None:
+            view_update()
+
+    view.stop_capture()
+    model.quit()
+    return model.get_state(), stats
+
+def replay_input(path, *, resource_dir='res', **kwargs):
+    """Play a game recorded by an InputRecorder again, headless and as fast
+    as it will go. Returns the same `(state, stats)` as `run_headless`, which
+    gets any other keyword arguments (like `capture`).
+    """
+    log = InputLog.load(path)
+    return run_headless(log.ticks, seed=log.seed, input_script=log.keysets(),
+            resource_dir=resource_dir, **kwargs)
+
+def parse_cli(argv=None):
+    """Parse command-line switches, provide defaults, and return them in a nice dictionary.
+    """
+    parser = argparse.ArgumentParser(description='Grapevine, a beat-em-up.')
+    parser.add_argument('--framerate', type=int, default=30,
+            help='model frames per second (default: %(default)s)')
+    parser.add_argument('--render-hz', type=int, default=60,
+            help='most screen updates per second (default: %(default)s)')
+    parser.add_argument('--dirty-rects', action='store_true',
+            help='only redraw the parts of the screen that changed')
+    parser.add_argument('--profile', action='store_true',
+            help='time each part of the main loop, and show the timings')
+    parser.add_argument('--seed', type=int, help='random seed (default: pick one)')
+    parser.add_argument('--record', metavar='PATH', help='record the input to PATH')
+    parser.add_argument('--replay', metavar='PATH',
+            help='replay the input recorded in PATH, headless, and print the result')
+    parser.add_argument('--capture', metavar='PATH',
+            help='record the screen to PATH: a directory (or pattern) of PNGs, or a raw file')
+    parser.add_argument('--capture-format', choices=FrameCapture.FORMATS, default='png',
+            help='how to write the --capture frames (default: %(default)s)')
+    options = parser.parse_args(argv)
+
+    args = vars(options)
+    args['resolution'] = (SCREEN_WIDTH, SCREEN_HEIGHT)
+    args['image_cache_bytes'] = 32 * 1024 * 1024
+    return args
+
+def main():
+    args = parse_cli()
+
+    if args['replay']:
+        start = time.perf_counter()
+        state, stats = replay_input(args['replay'], capture=args['capture'],
+                capture_format=args['capture_format'])
+        seconds = sum(tick.seconds for tick in stats)
+        print('{} frames in {:.3f}s, {:.0f} frames/s'.format(len(stats), seconds,
+                len(stats) / seconds if seconds else 0))
+        if args['capture']:
+            elapsed = time.perf_counter() - start
+            print('captured to {} in {:.3f}s ({:.1f}x real time)'.format(args['capture'],
+                    elapsed, len(stats) / args['framerate'] / elapsed))
+        print(json.dumps(state, indent=2))
+        sys.exit(0)
+
+    rmgr = GrapevineResourceManager(resource_dir='res',
+            cache_bytes=args['image_cache_bytes'])
+
+    # Start decoding the images while the window opens.
+    rmgr.prefetch(rmgr.list_images())
+
+    view = GrapevineView(resolution=args['resolution'],
+            resource_manager=rmgr, dirty_rects=args['dirty_rects'])
+    view.show_progress(rmgr.prefetch_progress)
+    model = GrapevineGame(view=view, seed=args['seed'])
+    recorder = InputRecorder(model) if args['record'] else None
+    if args['capture']:
+        view.start_capture(args['capture'], format=args['capture_format'])
+    controller = PygameController(model=model, view=view, framerate_hz=args['framerate'],
+            render_hz=args['render_hz'], profile=args['profile'])
+    if controller.stats is not None:
+        view.overlays.append(controller.stats.draw_overlay)
+
+    controller.run()
+
+    if recorder is not None:
+        recorder.log.save(args['record'])
+
+    capture = view.stop_capture()
+    if capture is not None:
+        print('{} frames captured, {} dropped'.format(capture.frames, capture.dropped))
+        if capture.format == 'raw':
+            print('ffmpeg ' + ' '.join(capture.ffmpeg_args(args['render_hz'])) + ' capture.mp4')
+
+    if controller.stats is not None:
+        print('\n'.join(controller.stats.report()))
+
+    sys.exit(0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""
+Play lots of Grapevine matches, headless, to see how the numbers play out.
+
+Each match is a GrapevineGame with its own seed, played by a simple computer
+player (see POLICIES) until every enemy is dead, the hero is dead, or time
+runs out. The matches are spread over a pool of processes, one per CPU core
+by default, and the results are collected as they come in. At the end, the
+script prints a report: win rate, time to kill, damage taken, and so on.
+
+To try out different stats, change the villains' FIELDS defaults with
+`--set`, and choose who to fight with `--enemies`:
+
+    python grapevine_balance.py --matches 2000
+    python grapevine_balance.py --set ShitClown.hp=1500 --set ShitClown.speed=2
+    python grapevine_balance.py --enemies ShitClown=3,JackScrapper=1 --policy mash
+
+With `--out`, each match's result is also written out, one JSON object per
+line, as soon as it finishes.
+
+Note that the villains don't fight back yet: they walk up to the hero, but
+never attack. So for now the damage taken is always 0, and a match can't be
+lost - only won, or timed out. The report says so, when that's the case.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#**************************************************************************
+#   PLAYERS
+#**************************************************************************
+
+def policy_idle(game, rng):
+    """Don't touch anything. (How long do the villains take to win?)"""
+    import grapevine
+    return lambda: grapevine.NO_KEYS
+
+def policy_mash(game, rng):
+    """Walk up to the nearest enemy, like the bot, and then just hold attack
+    - never block or jump. (Attacking roots the hero to the spot, so it
+    can't hold attack on the way there.)
+    """
+    import grapevine
+
+    hero = game.hero
+    enemy_list = game.enemy_list
+
+    def get_pressed():
+        if not enemy_list:
+            return grapevine.NO_KEYS
+
+        keys, dx, dy = approach(hero, enemy_list)
+        if abs(dx) <= REACH // 2 and abs(dy) <= REACH:
+            keys.append(grapevine.K_d)
+        return grapevine.KeySet(keys)
+
+    return get_pressed
+
+def policy_bot(game, rng):
+    """Walk up to the nearest enemy, stand off at arm's length (see
+    REACH), facing it, and attack. Every so often, block or jump instead -
+    the seeded `rng` decides when.
+    """
+    import grapevine
+    from grapevine import K_a, K_s, K_d
+
+    hero = game.hero
+    enemy_list = game.enemy_list
+
+    def get_pressed():
+        if not enemy_list:
+            return grapevine.NO_KEYS
+
+        keys, dx, dy = approach(hero, enemy_list)
+        if abs(dx) <= REACH // 2 and abs(dy) <= REACH:
+            roll = rng.random()
+            if roll < 0.1:
+                keys.append(K_a)
+            elif roll < 0.15:
+                keys.append(K_s)
+            else:
+                keys.append(K_d)
+
+        return grapevine.KeySet(keys)
+
+    return get_pressed
+
+def approach(hero, enemy_list):
+    """Return the keys that walk `hero` towards the nearest enemy, to REACH
+    away from it, and turn it to face the enemy. Also returns (dx, dy), how
+    far the hero still has to go.
+    """
+    from grapevine import K_LEFT, K_RIGHT, K_UP, K_DOWN
+
+    x, y = hero.rect.topleft
+    target = min(enemy_list, key=lambda villan: abs(villan.rect.x - x) + abs(villan.rect.y - y))
+    side = 1 if target.rect.x >= x else -1
+    dx = target.rect.x - side * REACH - x
+    dy = target.rect.y - y
+
+    keys = []
+    if abs(dx) > hero.speed:
+        keys.append(K_RIGHT if dx > 0 else K_LEFT)
+    elif hero.facing != side:
+        keys.append(K_RIGHT if side > 0 else K_LEFT)
+    if abs(dy) > hero.speed:
+        keys.append(K_DOWN if dy > 0 else K_UP)
+
+    return keys, dx, dy
+
+# How far (in pixels, left edge to left edge) the players stand from their
+# target. That puts the target in the middle of the Hero's punch.
+REACH = 40
+
+POLICIES = {
+    'bot': policy_bot,
+    'idle': policy_idle,
+    'mash': policy_mash,
+}
+
+#**************************************************************************
+#   WORKERS
+#**************************************************************************
+
+# Each worker process sets up the display and resources once, in
+# `init_worker`, and keeps them here for all the matches it plays.
+_view = None
+
+def init_worker(overrides, resource_dir):
+    """Runs once in each worker process, before any matches."""
+    global _view
+
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+    import grapevine
+
+    for cls_name, fields in overrides.items():
+        getattr(grapevine, cls_name).defaults.update(fields)
+
+    rmgr = grapevine.GrapevineResourceManager(resource_dir=resource_dir)
+    _view = grapevine.GrapevineView(resolution=(grapevine.SCREEN_WIDTH, grapevine.SCREEN_HEIGHT),
+            resource_manager=rmgr, headless=True)
+
+def play_match(seed, *, policy, enemies, max_ticks):
+    """Play one match, and return what happened as a dictionary."""
+    import grapevine
+
+    # The game adds its sprites to the view; don't keep the last match's.
+    _view.sprite_groups.clear()
+    game = grapevine.GrapevineGame(view=_view, seed=seed)
+
+    if enemies is not None:
+        for villan in list(game.enemy_list):
+            villan.kill()
+
+        rng = game.rng
+        for cls_name, count in enemies.items():
+            cls = getattr(grapevine, cls_name)
+            for _ in range(count):
+                villan = cls(store=game.villain_store)
+                villan.rect.x = rng.randrange(300, 400)
+                villan.rect.y = rng.randrange(200, 400)
+                game.add_character(villan, game.enemy_list)
+
+    game.get_pressed = POLICIES[policy](game, random.Random(seed))
+
+    hero = game.hero
+    enemy_list = game.enemy_list
+    hero_hp = hero.hp
+    enemy_hp = sum(villan.hp for villan in enemy_list)
+    enemy_count = len(enemy_list)
+
+    update_frame = game.update_frame
+    start = time.perf_counter()
+    outcome = 'timeout'
+    ticks = 0
+
+    while ticks < max_ticks:
+        update_frame()
+        ticks += 1
+
+        if not hero.alive():
+            outcome = 'loss'
+            break
+        if not enemy_list:
+            outcome = 'win'
+            break
+
+    game.quit()
+
+    return {
+        'seed': seed,
+        'outcome': outcome,
+        'ticks': ticks,
+        'seconds': time.perf_counter() - start,
+        'damage_taken': hero_hp - max(hero.hp, 0),
+        'damage_dealt': enemy_hp - sum(villan.hp for villan in enemy_list),
+        'kills': enemy_count - len(enemy_list),
+    }
+
+#**************************************************************************
+#   REPORTING
+#**************************************************************************
+
+class Tally:
+    """Adds up match results as they come in."""
+
+    def __init__(self):
+        self.results = []
+        self.outcomes = {'win': 0, 'loss': 0, 'timeout': 0}
+
+    def add(self, result):
+        self.results.append(result)
+        self.outcomes[result['outcome']] += 1
+
+    def report(self, framerate):
+        results = self.results
+        count = len(results)
+        lines = ['{} matches'.format(count)]
+        if not count:
+            return lines
+
+        for outcome, n in self.outcomes.items():
+            lines.append('  {:<8} {:6} ({:5.1f}%)'.format(outcome, n, 100.0 * n / count))
+
+        kill_ticks = sorted(result['ticks'] for result in results if result['outcome'] == 'win')
+        if kill_ticks:
+            lines.append('time to kill (wins): mean {:.1f}s, median {:.1f}s, p90 {:.1f}s'.format(
+                statistics.mean(kill_ticks) / framerate,
+                statistics.median(kill_ticks) / framerate,
+                kill_ticks[int(0.9 * (len(kill_ticks) - 1))] / framerate))
+
+        for field in ('damage_taken', 'damage_dealt', 'kills'):
+            values = [result[field] for result in results]
+            lines.append('{}: mean {:.1f}, min {}, max {}'.format(
+                field.replace('_', ' '), statistics.mean(values), min(values), max(values)))
+
+        if not any(result['damage_taken'] for result in results):
+            lines.append("(the villains never attack yet, so there's no damage taken, and no losses)")
+
+        ticks = sum(result['ticks'] for result in results)
+        seconds = sum(result['seconds'] for result in results)
+        lines.append('{} frames simulated, {:.0f} frames/s per worker'.format(
+            ticks, ticks / seconds if seconds else 0))
+        return lines
+
+#**************************************************************************
+#   MAIN
+#**************************************************************************
+
+def parse_fields(settings):
+    """Turn ['ShitClown.hp=1500', ...] into {'ShitClown': {'hp': 1500}}.
+    The class has to be a grapevine Character, and the field one of its
+    number FIELDS - so a typo is an error, not a run that changes nothing.
+    """
+    import grapevine
+
+    overrides = {}
+    for setting in settings:
+        target, _, value = setting.partition('=')
+        cls_name, _, field = target.partition('.')
+        if not field or not value:
+            raise argparse.ArgumentTypeError('Expected Class.field=value, not {!r}'.format(setting))
+
+        cls = getattr(grapevine, cls_name, None)
+        if not (isinstance(cls, type) and issubclass(cls, grapevine.Character)):
+            raise argparse.ArgumentTypeError('{!r} is not a character class'.format(cls_name))
+        default = cls.defaults.get(field)
+        if not isinstance(default, int):
+            raise argparse.ArgumentTypeError('{} has no number field {!r} (it has: {})'.format(
+                cls_name, field, ', '.join(name for name, value in cls.defaults.items()
+                                           if isinstance(value, int))))
+        try:
+            overrides.setdefault(cls_name, {})[field] = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('{} needs a whole number, not {!r}'.format(
+                target, value)) from None
+    return overrides
+
+def parse_enemies(spec):
+    """Turn 'ShitClown=3,JackScrapper=1' into {'ShitClown': 3, 'JackScrapper': 1}."""
+    enemies = {}
+    for part in spec.split(','):
+        cls_name, _, count = part.partition('=')
+        enemies[cls_name.strip()] = int(count) if count else 1
+    return enemies
+
+def parse_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Play lots of Grapevine matches, headless.')
+    parser.add_argument('--matches', type=int, default=200,
+            help='how many matches to play (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+            help='seed of the first match; the rest count up from it (default: %(default)s)')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='bot',
+            help='who plays the hero (default: %(default)s)')
+    parser.add_argument('--enemies', type=parse_enemies,
+            help='who to fight, like ShitClown=3,JackScrapper=1 (default: what the game spawns)')
+    parser.add_argument('--set', action='append', default=[], metavar='CLASS.FIELD=VALUE',
+            help='change a FIELDS default, like ShitClown.hp=1500 (can be repeated)')
+    parser.add_argument('--max-seconds', type=float, default=120,
+            help='game time before a match is a timeout (default: %(default)s)')
+    parser.add_argument('--framerate', type=int, default=30,
+            help='model frames per second of game time (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+            help='worker processes (default: one per core, %(default)s)')
+    parser.add_argument('--resource-dir', default='res')
+    parser.add_argument('--out', help='write each result to this file, as a line of JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        args.overrides = parse_fields(args.set)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    return args
+
+def main(argv=None):
+    args = parse_cli(argv)
+    overrides = args.overrides
+    max_ticks = int(args.max_seconds * args.framerate)
+
+    tally = Tally()
+    out = open(args.out, 'w') if args.out else None
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+            initargs=(overrides, args.resource_dir)) as pool:
+        futures = [pool.submit(play_match, args.seed + n, policy=args.policy,
+                               enemies=args.enemies, max_ticks=max_ticks)
+                   for n in range(args.matches)]
+
+        for done, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            tally.add(result)
+            if out is not None:
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+
+            if done % 100 == 0 or done == args.matches:
+                print('\r{}/{} matches, {:.1f}s'.format(done, args.matches,
+                        time.perf_counter() - start), end='', file=sys.stderr, flush=True)
+
+    print(file=sys.stderr)
+    if out is not None:
+        out.close()
+
+    print('\n'.join(tally.report(args.framerate)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
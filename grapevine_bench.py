@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the Grapevine game loop.
+
+Each scenario builds a real game - resource manager, view, GrapevineGame and
+PygameController - sets up its sprite groups, and then steps the controller
+as fast as it will go (see `PygameController.step`). The window is drawn
+with SDL's "dummy" video driver, so nothing shows up on screen, but all the
+blitting still happens.
+
+For every scenario this reports frame times (mean, p50, p99, max), frames
+per second, memory allocated per frame (measured with `tracemalloc`, in a
+separate, shorter run, because tracing slows everything down), and the
+peak resident memory of the process so far.
+
+Usage:
+
+    python grapevine_bench.py                       # run everything
+    python grapevine_bench.py clowns_100 hero_alone # run some scenarios
+    python grapevine_bench.py --out new.json --baseline old.json
+
+With `--baseline`, the results are compared against an earlier `--out`
+file, and the exit status is 1 if any scenario got slower by more than
+`--tolerance` percent.
+
+The combat scenarios (MUST_HIT) double as a check on the combat code: the
+hero is attacking in the middle of a crowd, so if nobody loses any hp, the
+exit status is 1 too - a fast frame that misses isn't a win.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+# Must be set before pygame initializes its display.
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+import pygame
+
+import grapevine
+
+from grapevine import K_d, K_RIGHT, KeySet, NO_KEYS, percentile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#**************************************************************************
+#   SCENARIOS
+#**************************************************************************
+
+def spawn_clowns(game, count, *, around=None, spread=None, hp=None):
+    """Add `count` more ShitClowns to the game. They are scattered over the
+    playable screen, or within `spread` pixels of the point `around`.
+    """
+    rng = game.rng
+    for _ in range(count):
+        clown = grapevine.ShitClown(store=game.villain_store)
+        if around is None:
+            clown.rect.x = rng.randrange(0, grapevine.PLAYABLE_SCREEN_WIDTH)
+            clown.rect.y = rng.randrange(0, grapevine.PLAYABLE_SCREEN_HEIGHT)
+        else:
+            clown.rect.x = around[0] + rng.randrange(-spread, spread + 1)
+            clown.rect.y = around[1] + rng.randrange(-spread, spread + 1)
+        if hp is not None:
+            clown.hp = hp
+        game.add_character(clown, game.enemy_list)
+
+def remove_enemies(game):
+    for villan in list(game.enemy_list):
+        villan.kill()
+
+def setup_hero_alone(game):
+    remove_enemies(game)
+    return NO_KEYS
+
+def setup_clowns(count):
+    def setup(game):
+        remove_enemies(game)
+        spawn_clowns(game, count)
+        return NO_KEYS
+    return setup
+
+def setup_heavy_combat(game):
+    """A crowd of clowns right on top of the hero, who attacks non-stop.
+    They get plenty of hp, so the crowd lasts the whole run.
+    """
+    remove_enemies(game)
+    spawn_clowns(game, 100, around=game.hero.rect.topleft, spread=20, hp=10**9)
+    return KeySet((K_d, K_RIGHT))
+
+def setup_point_blank(game):
+    """A few clowns standing right where the hero is, while the hero
+    attacks. They have to step back to where the punch lands.
+    """
+    remove_enemies(game)
+    spawn_clowns(game, 10, around=game.hero.rect.topleft, spread=0, hp=10**9)
+    return KeySet((K_d,))
+
+SCENARIOS = {
+    'hero_alone': setup_hero_alone,
+    'clowns_10': setup_clowns(10),
+    'clowns_100': setup_clowns(100),
+    'clowns_1000': setup_clowns(1000),
+    'heavy_combat': setup_heavy_combat,
+    'point_blank': setup_point_blank,
+}
+
+# Scenarios where the hero's attacks have to land on someone.
+MUST_HIT = ('heavy_combat', 'point_blank')
+
+#**************************************************************************
+#   MEASUREMENT
+#**************************************************************************
+
+def build_game(seed):
+    """Build the whole game, the same way grapevine.main() does."""
+    rmgr = grapevine.GrapevineResourceManager(resource_dir='res')
+    view = grapevine.GrapevineView(resolution=(grapevine.SCREEN_WIDTH, grapevine.SCREEN_HEIGHT),
+            resource_manager=rmgr)
+    model = grapevine.GrapevineGame(view=view, seed=seed)
+    controller = grapevine.PygameController(model=model, view=view)
+
+    # Nobody is at the keyboard. Keep window events out of the queue, so
+    # every run sees exactly the same thing.
+    pygame.event.set_blocked(None)
+    pygame.event.clear()
+    return controller
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_scenario(name, setup, *, frames, alloc_frames, seed):
+    controller = build_game(seed)
+    model = controller.model
+    keys = setup(model)
+    model.get_pressed = lambda: keys
+    step = controller.step
+    perf_counter = time.perf_counter
+    enemy_hp = sum(villan.hp for villan in model.enemy_list)
+
+    # Let the caches and the state machine settle down first.
+    for _ in range(10):
+        step()
+
+    times = []
+    start = perf_counter()
+    for _ in range(frames):
+        t0 = perf_counter()
+        step()
+        times.append(perf_counter() - t0)
+    total = perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    peak_bytes = 0
+    for _ in range(alloc_frames):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        step()
+        peak_bytes += tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+    times.sort()
+    return {
+        'frames': frames,
+        'enemies': len(model.enemy_list),
+        'damage_dealt': enemy_hp - sum(villan.hp for villan in model.enemy_list),
+        'mean_ms': 1000.0 * total / frames,
+        'p50_ms': 1000.0 * percentile(times, 50),
+        'p99_ms': 1000.0 * percentile(times, 99),
+        'max_ms': 1000.0 * times[-1],
+        'ticks_per_sec': frames / total,
+        'alloc_bytes_per_tick': peak_bytes / alloc_frames,
+        'retained_blocks_per_tick': retained_blocks / alloc_frames,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+def run_cold_start(*, repeats, seed):
+    """Time building the game from nothing, with an empty image cache.
+    Each repeat gets a brand new resource manager.
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        build_game(seed)
+        times.append(time.perf_counter() - t0)
+
+    times.sort()
+    return {
+        'repeats': repeats,
+        'mean_ms': 1000.0 * sum(times) / repeats,
+        'p50_ms': 1000.0 * percentile(times, 50),
+        'p99_ms': 1000.0 * percentile(times, 99),
+        'max_ms': 1000.0 * times[-1],
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+#**************************************************************************
+#   REPORTING
+#**************************************************************************
+
+def compare(results, baseline, tolerance):
+    """Print each scenario's mean frame time against the baseline. Returns
+    the names of the scenarios that got more than `tolerance` percent slower.
+    """
+    slower = []
+    for name, result in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if old is None:
+            print('{:<14} (not in baseline)'.format(name))
+            continue
+
+        change = 100.0 * (result['mean_ms'] - old['mean_ms']) / old['mean_ms']
+        flag = ''
+        if change > tolerance:
+            flag = '  <-- SLOWER'
+            slower.append(name)
+        print('{:<14} {:9.3f} ms -> {:9.3f} ms  {:+6.1f}%{}'.format(
+            name, old['mean_ms'], result['mean_ms'], change, flag))
+
+    return slower
+
+def parse_cli(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Grapevine game loop.')
+    parser.add_argument('scenarios', nargs='*',
+            help='scenarios to run (default: all of {})'.format(
+                ', '.join(list(SCENARIOS) + ['cold_start'])))
+    parser.add_argument('--frames', type=int, default=600,
+            help='timed frames per scenario (default: %(default)s)')
+    parser.add_argument('--alloc-frames', type=int, default=60,
+            help='frames traced for allocations (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this earlier --out file')
+    parser.add_argument('--tolerance', type=float, default=10.0,
+            help='percent slowdown allowed before failing (default: %(default)s)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_cli(argv)
+    names = args.scenarios or list(SCENARIOS) + ['cold_start']
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'numpy': grapevine.numpy is not None,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'scenarios': {},
+    }
+
+    missed = []
+    for name in names:
+        if name == 'cold_start':
+            result = run_cold_start(repeats=5, seed=args.seed)
+        elif name in SCENARIOS:
+            result = run_scenario(name, SCENARIOS[name], frames=args.frames,
+                    alloc_frames=args.alloc_frames, seed=args.seed)
+        else:
+            sys.exit('Unknown scenario: {}'.format(name))
+
+        results['scenarios'][name] = result
+        print('{:<14} mean {:8.3f} ms  p50 {:8.3f} ms  p99 {:8.3f} ms'.format(
+            name, result['mean_ms'], result['p50_ms'], result['p99_ms']))
+        if name in MUST_HIT and not result['damage_dealt']:
+            print('{:<14} the hero never hit anyone  <-- MISSED'.format(name))
+            missed.append(name)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 1 if missed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Build the image bundle for Grapevine.
+
+This decodes every image under res/img and writes the pixels, all together,
+into res/img.bundle. When that file is there, the game maps it into memory
+at startup instead of opening and decoding the images one at a time. (See
+`PygameResourceManager.build_bundle`.)
+
+The pixels are stored in the format of this machine's display, so build the
+bundle on the machine that runs the game. Build it again whenever an image
+changes - the game doesn't check whether the bundle is out of date. Delete
+it to go back to loading the loose files.
+
+Usage:
+
+    python grapevine_bundle.py [--resource-dir res]
+"""
+
+import os
+import sys
+import argparse
+
+# Only a display is needed, for its pixel format. Don't open a window.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+import pygame
+
+import grapevine
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the Grapevine image bundle.')
+    parser.add_argument('--resource-dir', default='res')
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    rmgr = grapevine.GrapevineResourceManager(resource_dir=args.resource_dir)
+    index = rmgr.build_image_bundle()
+
+    path = rmgr.get_path(rmgr.BUNDLE)
+    print('{}: {} images, {} bytes'.format(path, len(index), os.path.getsize(path)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())